@@ -0,0 +1,223 @@
+### Offline benchmark of the Idea2Img orchestration: a local stand-in for the chat-completions
+### endpoint, the CPU stub T2I backend, and a sweep of pipeline settings.
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import itertools
+import shutil
+import threading
+import subprocess
+import http.server
+
+## the pipeline runs from its own directory, so every path handed to it or cleaned up is resolved there
+here = os.path.dirname(os.path.abspath(__file__))
+
+class fake_gpt_handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload, headers={}):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, text, duration):
+        ## server-sent events, one delta per word spread over `duration`, like a model writing tokens
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        words = text.split(' ')
+        for ii, word in enumerate(words):
+            time.sleep(duration/len(words))
+            delta = word if ii == 0 else ' '+word
+            self.wfile.write(b'data: %s\n\n'%json.dumps({'choices': [{'index': 0, 'delta': {'content': delta}}]}).encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.requests += 1
+            server.bytes_received += len(body)
+        request = json.loads(body)
+        latency = max(0., random.gauss(server.latency, server.jitter))
+        ## streamed requests see the first token after a fifth of the latency, the rest arrives gradually
+        time.sleep(latency*0.2 if request.get('stream') else latency)
+        roll = random.random()
+        if roll < server.rate_429:
+            with server.lock: server.errors += 1
+            return self.reply(429, {'error': {'code': '429', 'message': 'rate limited'}}, {'Retry-After': '%g'%server.retry_after})
+        if roll < server.rate_429+server.rate_500:
+            with server.lock: server.errors += 1
+            return self.reply(500, {'error': {'code': '500', 'message': 'injected failure'}})
+        text = canned_response(request)
+        if request.get('stream'):
+            return self.stream(text, latency*0.8)
+        self.reply(200, {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                         'usage': {'prompt_tokens': len(body)//4, 'completion_tokens': len(text)//4, 'total_tokens': len(body)//4+len(text)//4}})
+
+def request_text(request):
+    parts = []
+    for message in request['messages']:
+        for content in message['content']:
+            if content.get('type') == 'text':
+                parts.append(content['text'])
+    return ''.join(parts)
+
+def canned_response(request):
+    ## answers in the <START>...<END> format each gptv_* stage parses
+    text = request_text(request)
+    if 'You are a judge to rank provided images' in text:
+        num_img = int(text.split('Below are ')[1].split(' images')[0])
+        scores = [random.randint(3, 9) for _ in range(num_img)]
+        ## judges do not always follow the requested format exactly: vary case, markdown and a /10 suffix
+        note = random.choice(['Image %d: the image partially follows the IDEA. Overall score: %d.',
+                              '**Image %d**: the image partially follows the IDEA. **Overall Score:** %d/10',
+                              'image %d: the image partially follows the IDEA. overall score: %d / 10'])
+        notes = ' '.join(note%(ii, score) for ii, score in enumerate(scores))
+        return '%s Best image: <START>%d<END>'%(notes, scores.index(max(scores)))
+    if 'Here are some rules to write good key REASON' in text:
+        return '<START> The generated image misses some details of the IDEA; the prompt should describe them explicitly. <END>'
+    num_prompt = int(text.rsplit('you will write ', 1)[1].split(' detailed prompts')[0])
+    return ' '.join('<START> A detailed scene for the idea, variant %d, soft lighting, high detail <END>'%(ii+random.randint(0, 10**6)) for ii in range(num_prompt))
+
+def start_fake_gpt(port=0, latency=0.5, jitter=0.1, rate_429=0., rate_500=0., retry_after=1.):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), fake_gpt_handler)
+    server.daemon_threads = True
+    server.latency, server.jitter = latency, jitter
+    server.rate_429, server.rate_500, server.retry_after = rate_429, rate_500, retry_after
+    server.lock = threading.Lock()
+    reset_counters(server)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def reset_counters(server):
+    with server.lock:
+        server.requests, server.bytes_received, server.errors = 0, 0, 0
+
+IDEAS = [
+    'a red fox reading a newspaper on a park bench',
+    '8 apples on the table',
+    'a person practicing yoga boat pose at beach with no boats nearby',
+    'photo of a dog looks like the one in the given image on the grass, but change the dog color to blue <IMG>input_img/dog2.jpg',
+    'painting of a corgi dog with style similar to this one in the image <IMG>input_img/style4.jpg',
+    'a lighthouse on a cliff during a thunderstorm, watercolor',
+]
+
+def write_testfile(path, num_samples):
+    with open(path, 'w') as f:
+        for ii in range(num_samples):
+            idea = IDEAS[ii%len(IDEAS)]
+            text, sep, img = idea.partition('<IMG>')
+            f.write('%s variant %d %s%s\n'%(text.strip(), ii, sep, img))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values)*q), len(values)-1)] if values else 0.
+
+def stage_latencies(trace_dir):
+    stages = {}
+    for name in os.listdir(trace_dir):
+        if name.startswith('metrics.') and name.endswith('.jsonl'):
+            with open(os.path.join(trace_dir, name)) as f:
+                for line in f:
+                    event = json.loads(line)
+                    stages.setdefault(event['name'], []).append(event['seconds'])
+    return {name: {'count': len(v), 'p50': percentile(v, 0.5), 'p95': percentile(v, 0.95), 'p99': percentile(v, 0.99)} for name, v in sorted(stages.items())}
+
+def run_scenario(scenario, server, args):
+    name = 'p%d_r%d_n%d_%s'%(scenario['num_prompt'], scenario['max_rounds'], scenario['samples'], scenario['fewshot'])
+    workdir = os.path.join(here, args.outdir, name)
+    os.makedirs(workdir, exist_ok=True)
+    testfile = os.path.join(workdir, 'testfile.txt')
+    write_testfile(testfile, scenario['samples'])
+    trace_dir = os.path.join(workdir, 'trace')
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(here, 'output', args.foldername, name), ignore_errors=True)
+    cmd = [sys.executable, 'idea2img_pipeline.py', '--t2i_model', 'stub', '--stub_delay', str(args.stub_delay), '--api_key', 'benchmark',
+           '--testfile', testfile, '--foldername', os.path.join(args.foldername, name), '--trace_dir', trace_dir,
+           '--num_prompt', str(scenario['num_prompt']), '--max_rounds', str(scenario['max_rounds'])] + args.pipeline_args.split()
+    if scenario['fewshot'] in ('reflect', 'both'): cmd.append('--fewshot')
+    if scenario['fewshot'] in ('select', 'both'): cmd.append('--select_fewshot')
+    env = dict(os.environ, OPENAI_ENDPOINT='http://127.0.0.1:%d'%server.server_address[1])
+    reset_counters(server)
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'pipeline.log'), 'w') as log:
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=here)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter()-start
+    return {'scenario': name, **scenario, 'exit_status': status, 'wall_s': wall,
+            'samples_per_hour': scenario['samples']*3600./wall, 'gpt_requests': server.requests, 'gpt_errors_injected': server.errors,
+            'bytes_sent': server.bytes_received, 'peak_rss_mb': rusage.ru_maxrss/1024., 'stages': stage_latencies(trace_dir) if os.path.isdir(trace_dir) else {}}
+
+def report(results, baseline=None, tolerance=0.1):
+    print('%-22s %8s %10s %6s %10s %8s  %s'%('scenario', 'wall s', 'samples/h', 'reqs', 'sent MB', 'rss MB', 'stage p50/p95 s'))
+    regressions = []
+    for result in results:
+        stages = ', '.join('%s %.2f/%.2f'%(k, v['p50'], v['p95']) for k, v in result['stages'].items() if k.startswith('gpt.') or k.startswith('t2i.'))
+        print('%-22s %8.1f %10.1f %6d %10.2f %8.1f  %s'%(result['scenario'], result['wall_s'], result['samples_per_hour'], result['gpt_requests'], result['bytes_sent']/1024/1024, result['peak_rss_mb'], stages))
+        if result['exit_status'] != 0:
+            regressions.append('%s: pipeline exited with status %d'%(result['scenario'], result['exit_status']))
+        previous = (baseline or {}).get(result['scenario'])
+        if previous is not None:
+            for key, higher_is_better in [('samples_per_hour', True), ('bytes_sent', False), ('peak_rss_mb', False)]:
+                change = (result[key]-previous[key])/max(previous[key], 1e-9)
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append('%s: %s %.4g -> %.4g'%(result['scenario'], key, previous[key], result[key]))
+    for line in regressions:
+        print('REGRESSION %s'%line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_prompt", type=int, nargs='+', default=[1, 3])
+    parser.add_argument("--max_rounds", type=int, nargs='+', default=[1, 3])
+    parser.add_argument("--samples", type=int, nargs='+', default=[4])
+    parser.add_argument("--fewshot", type=str, nargs='+', default=['none', 'both'], choices=['none', 'reflect', 'select', 'both'])
+    parser.add_argument("--latency", type=float, default=0.5, help="mean latency of the stand-in GPT endpoint")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--rate_429", type=float, default=0.05, help="fraction of requests answered with 429")
+    parser.add_argument("--rate_500", type=float, default=0.02, help="fraction of requests answered with 500")
+    parser.add_argument("--retry_after", type=float, default=1.)
+    parser.add_argument("--stub_delay", type=float, default=0.2, help="seconds per image of the stub T2I backend")
+    parser.add_argument("--pipeline_args", type=str, default="", help="extra arguments passed to idea2img_pipeline.py")
+    parser.add_argument("--foldername", type=str, default="bench")
+    parser.add_argument("--outdir", type=str, default="output/bench_runs", help="relative paths are resolved against this script's directory")
+    parser.add_argument("--results", type=str, default="output/bench_runs/results.json", help="relative paths are resolved against this script's directory")
+    parser.add_argument("--baseline", type=str, default=None, help="results.json of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change that counts as a regression")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server = start_fake_gpt(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, rate_500=args.rate_500, retry_after=args.retry_after)
+    results = []
+    for num_prompt, max_rounds, samples, fewshot in itertools.product(args.num_prompt, args.max_rounds, args.samples, args.fewshot):
+        results.append(run_scenario({'num_prompt': num_prompt, 'max_rounds': max_rounds, 'samples': samples, 'fewshot': fewshot}, server, args))
+    results_path = os.path.join(here, args.results)
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = {x['scenario']: x for x in json.load(f)}
+    regressions = report(results, baseline, args.tolerance)
+    server.shutdown()
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
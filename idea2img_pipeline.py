@@ -1,98 +1,664 @@
 ### Set up environment variables:
 import os
 import time
+_import_start = time.perf_counter()
 import argparse
 import csv, json
-import cv2, base64
+import base64
+import io
 from tqdm import tqdm
 import requests
+import requests.adapters
 import random
-import torch
+import re
+import asyncio
+import hashlib
+import threading
+import socket
+import shutil
+import functools
+import concurrent.futures
+import fcntl
+import heapq
+import itertools
+import uuid
+import secrets
+import http.server
+import multiprocessing.connection
+import contextvars
+import collections
+from collections import OrderedDict
 # from datetime import datetime
 from PIL import Image
 
 from dotenv import load_dotenv
-from azure.identity import DefaultAzureCredential
 
 load_dotenv()
 
+class startup_timer():
+    ## wall time of each startup phase, reported once the backend is loaded
+    def __init__(self, start):
+        self.last = start
+        self.phases = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now-self.last))
+        self.last = now
+
+    def report(self):
+        return 'startup: %s, total %.2fs'%(', '.join('%s %.2fs'%(name, t) for name, t in self.phases), sum(t for _, t in self.phases))
+
+startup = startup_timer(_import_start)
+
+class trace_span():
+    def __init__(self, tracer, name, attrs):
+        self.tracer, self.name, self.attrs = tracer, name, attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.record(self, time.perf_counter())
+        return False
+
+class tracer():
+    ## spans around GPT calls, diffusion, image encoding and file io; streamed to a JSONL metrics
+    ## file, exported as a Chrome/Perfetto trace and summarised per span name at the end of a run.
+    ## Memory stays bounded in long-running (--serve) processes: the summary keeps running totals and
+    ## the latest `window` durations per name, and raw events are only kept, up to `max_events`, while
+    ## a trace is open
+    window, max_events = 4096, 200000
+    additive = ('bytes', 'bytes_in', 'bytes_out', 'est_tokens', 'prompt_tokens', 'completion_tokens', 'retries', 'cache_hit', 'images', 'queue_wait', 'skipped', 'reused', 'dropped')
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = collections.deque(maxlen=self.max_events)
+        self.stats = OrderedDict()
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.metrics_file = None
+
+    def open(self, trace_dir):
+        os.makedirs(trace_dir, exist_ok=True)
+        self.trace_dir = trace_dir
+        self.tag = '%s.%d'%(socket.gethostname(), os.getpid())
+        self.metrics_file = open(os.path.join(trace_dir, 'metrics.%s.jsonl'%self.tag), 'a')
+
+    def span(self, name, **attrs):
+        sample = current_sample.get()
+        if sample is not None:
+            attrs.setdefault('sample', sample)
+        return trace_span(self, name, attrs)
+
+    def lane(self):
+        ## concurrent asyncio tasks share a thread, so each task gets its own row in the trace viewer
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        key = ('task', id(task)) if task is not None else ('thread', threading.get_ident())
+        with self.lock:
+            if key not in self.lanes:
+                self.lanes[key] = (len(self.lanes)+1, task.get_name() if task is not None else threading.current_thread().name)
+        return self.lanes[key][0]
+
+    def record(self, span, end):
+        seconds = end-span.start
+        tid = self.lane() if self.metrics_file is not None else None
+        with self.lock:
+            stats = self.stats.get(span.name)
+            if stats is None:
+                stats = self.stats[span.name] = {'count': 0, 'total': 0., 'max': 0., 'recent': collections.deque(maxlen=self.window), 'totals': OrderedDict()}
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['recent'].append(seconds)
+            for k, v in span.attrs.items():
+                if k in self.additive:
+                    stats['totals'][k] = stats['totals'].get(k, 0) + v
+            if self.metrics_file is not None:
+                self.events.append({'name': span.name, 'ts': (span.start-self.origin)*1e6, 'dur': seconds*1e6, 'tid': tid, 'args': span.attrs})
+                self.metrics_file.write(json.dumps({'name': span.name, 'start': span.start-self.origin, 'seconds': end-span.start, **span.attrs}, default=str)+'\n')
+                self.metrics_file.flush()
+
+    def export(self):
+        if self.metrics_file is None:
+            return
+        lane_names = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}} for tid, name in self.lanes.values()]
+        events = [{'name': x['name'], 'cat': x['name'].split('.')[0], 'ph': 'X', 'ts': x['ts'], 'dur': x['dur'], 'pid': os.getpid(), 'tid': x['tid'], 'args': x['args']} for x in self.events]
+        with open(os.path.join(self.trace_dir, 'trace.%s.json'%self.tag), 'w') as f:
+            json.dump({'traceEvents': lane_names+events}, f, default=str)
+        self.metrics_file.close()
+        self.metrics_file = None
+        self.events.clear()
+
+    def summary(self):
+        ## p50/p95 over the latest `window` spans of each name, count/total/max over all of them
+        lines = ['%-24s %6s %9s %8s %8s %8s  %s'%('span', 'count', 'total s', 'p50 s', 'p95 s', 'max s', 'totals')]
+        with self.lock:
+            for name, stats in self.stats.items():
+                durations = sorted(stats['recent'])
+                lines.append('%-24s %6d %9.2f %8.2f %8.2f %8.2f  %s'%(name, stats['count'], stats['total'], durations[len(durations)//2],
+                    durations[min(int(len(durations)*0.95), len(durations)-1)], stats['max'], ', '.join('%s=%g'%(k, v) for k, v in stats['totals'].items())))
+        return '\n'.join(lines)
+
+current_sample = contextvars.ContextVar('current_sample', default=None)
+trace = tracer()
+
+def traced(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with trace.span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
 managed_identity_client_id = os.environ.get("MANAGED_IDENTITY_CLIENT_ID")
 openai_endpoint = os.environ.get("OPENAI_ENDPOINT")
 
-token_credential = DefaultAzureCredential(managed_identity_client_id=managed_identity_client_id)
+def text_part(text):
+    return {"type": "text", "text": text}
 
-token = token_credential.get_token('https://cognitiveservices.azure.com/.default')
+class frozen_parts(tuple):
+    ## immutable run of message content parts, serialized to json once and spliced
+    ## verbatim into every request body that uses it
+    def __new__(cls, parts):
+        parts = tuple(text_part(x) if type(x) == str else x for x in parts)
+        self = super().__new__(cls, parts)
+        self.json = ', '.join(json.dumps(x) for x in parts)
+        self.tokens = estimate_tokens(parts)
+        return self
 
-def gptv_query(transcript=None, temp=0.):
-    max_tokens = 512
-    wait_time = 10
+def content_json(content):
+    out = []
+    for part in content:
+        if isinstance(part, frozen_parts):
+            if len(part): out.append(part.json)
+        elif type(part) == str:
+            out.append(json.dumps(text_part(part)))
+        else:
+            out.append(json.dumps(part))
+    return '[%s]'%', '.join(out)
 
-    for x in range(len(transcript)):
-        message = transcript[x]
-        new_content = []
-        for content in message["content"]:
-            if type(content) == str:
-                new_content.append({
-                    "type": "text",
-                    "text": content
-                })
-            else:
-                new_content.append(content)
-        message["content"] = new_content
+def serialize_body(data):
+    messages = ', '.join('{"role": %s, "content": %s}'%(json.dumps(message["role"]), content_json(message["content"])) for message in data['messages'])
+    head = json.dumps({k:v for k,v in data.items() if k != 'messages'})
+    return '%s, "messages": [%s]}'%(head[:-1], messages)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token.token}"
-    }
-    data = {
-        'model': 'gpt-4o',
-        'max_tokens':max_tokens, 
-        'temperature': temp,
-        'top_p': 0.5,
-        'messages':[]
-    }
-    if transcript is not None:
-        data['messages'] = transcript
+def estimate_tokens(content):
+    ## rough prompt size: ~4 characters per text token, fixed cost per low detail image
+    tokens = 0
+    for part in content:
+        if isinstance(part, frozen_parts):
+            tokens += part.tokens
+        elif type(part) == str:
+            tokens += len(part)//4 + 1
+        elif part.get("type") == "image_url":
+            tokens += 85 if part["image_url"].get("detail") == "low" else 765
+        elif part.get("type") == "text":
+            tokens += len(part["text"])//4 + 1
+    return tokens
+
+class gpt_error(Exception):
+    pass
+
+class rate_limiter():
+    ## token bucket refilled continuously up to `per_minute`
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self, amount=1):
+        if not self.per_minute:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        amount = min(amount, self.per_minute)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.level = min(self.per_minute, self.level + (now-self.updated)*self.per_minute/60.)
+                self.updated = now
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount-self.level)*60./self.per_minute)
+
+class response_cache():
+    ## completed GPT responses on disk, one file per sha256 of the serialized request body,
+    ## evicted least recently used first once the directory grows past max_bytes
+    def __init__(self, cache_dir, max_bytes=512*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.nbytes = sum(os.path.getsize(os.path.join(self.cache_dir, x)) for x in os.listdir(self.cache_dir) if x.endswith('.json'))
 
-    response_text, retry, response_json = '', 0, None
-    while len(response_text)<2:
-        retry += 1
+    def key(self, body):
+        return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key+'.json')
+
+    def get(self, key):
         try:
-            response = requests.post(openai_endpoint, headers=headers, data=json.dumps(data)) 
-            response_json = response.json()
-        except Exception as e:
-            if random.random()<1: print(e)
-            time.sleep(wait_time)
-            continue
-        if response.status_code != 200:
-            if random.random()<0.01: print(f"The response status code for is {response.status_code} (Not OK)")
-            time.sleep(wait_time)
-            data['temperature'] = min(data['temperature'] + 0.2, 1.0)
-            continue
-        if 'choices' not in response_json:
-            time.sleep(wait_time)
-            continue
-        response_text = response_json["choices"][0]["message"]["content"]
-        print(response_text)
-    return response_json["choices"][0]["message"]["content"]
+            with open(self.path(key), 'r') as f:
+                entry = json.load(f)
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry['response']
+
+    def put(self, key, response_text, temp):
+        entry = json.dumps({'response': response_text, 'temperature': temp, 'created': time.time()})
+        tmp_path = '%s.%d.%d.tmp'%(self.path(key), os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            f.write(entry)
+        existed = os.path.exists(self.path(key))
+        os.replace(tmp_path, self.path(key))
+        with self.lock:
+            if not existed:
+                self.nbytes += len(entry)
+            if self.nbytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = []
+        for x in os.listdir(self.cache_dir):
+            if x.endswith('.json'):
+                stat = os.stat(os.path.join(self.cache_dir, x))
+                entries.append((stat.st_mtime, stat.st_size, x))
+        entries.sort()
+        self.nbytes = sum(x[1] for x in entries)
+        for _, size, x in entries:
+            if self.nbytes <= self.max_bytes*0.9:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, x))
+            except OSError:
+                continue
+            self.nbytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        return 'gpt response cache: %d hits, %d misses, %d evictions, %.1f MB'%(self.hits, self.misses, self.evictions, self.nbytes/1024/1024)
+
+class gpt_client():
+    ## chat-completions client shared by all gptv_* calls: pooled keep-alive connections,
+    ## concurrency and RPM/TPM limits, jittered exponential backoff honouring Retry-After,
+    ## and an AAD token refreshed before it expires. Blocking HTTP runs on worker threads.
+    retry_status = (408, 409, 429, 500, 502, 503, 504)
+
+    def __init__(self, endpoint=None, api_key=None, max_concurrency=4, rpm=0, tpm=0, max_retries=8, backoff_base=1., backoff_max=60., timeout=180., refresh_margin=300., cache=None, cache_mode='off'):
+        self.endpoint = endpoint if endpoint is not None else openai_endpoint
+        self.api_key = api_key
+        ## cache_mode: 'on' serves and stores, 'record' always queries and stores, 'replay' serves only and never queries
+        self.cache = cache if cache_mode != 'off' else None
+        self.cache_mode = cache_mode
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base, self.backoff_max = backoff_base, backoff_max
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(max_concurrency,1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.request_limiter, self.token_limiter = rate_limiter(rpm), rate_limiter(tpm)
+        self.semaphores = {}
+        self.credential, self.token = None, None
+        self.token_lock = threading.Lock()
+        self.requests_sent, self.bytes_sent, self.max_request_bytes = 0, 0, 0
+        self.queries, self.est_tokens_total, self.max_est_tokens = 0, 0, 0
+        self.streaming, self.streamed = True, 0
+
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self.semaphores:
+            self.semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self.semaphores[loop]
+
+    def auth_headers(self, force_refresh=False):
+        if self.api_key:
+            return {"api-key": self.api_key}
+        with self.token_lock:
+            if force_refresh or self.token is None or self.token.expires_on - time.time() < self.refresh_margin:
+                if self.credential is None:
+                    from azure.identity import DefaultAzureCredential
+                    self.credential = DefaultAzureCredential(managed_identity_client_id=managed_identity_client_id)
+                self.token = self.credential.get_token('https://cognitiveservices.azure.com/.default')
+            return {"Authorization": f"Bearer {self.token.token}"}
+
+    def backoff(self, attempt, response=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        if response is not None:
+            retry_after = response.headers.get('retry-after-ms')
+            retry_after = float(retry_after)/1000. if retry_after else response.headers.get('Retry-After')
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def post(self, body, force_refresh=False):
+        headers = {"Content-Type": "application/json"}
+        headers.update(self.auth_headers(force_refresh))
+        return self.session.post(self.endpoint, headers=headers, data=body.encode('utf-8'), timeout=self.timeout)
+
+    def post_stream(self, body, force_refresh, on_text):
+        ## server-sent events: on_text gets the text so far whenever a delta may have closed a tag.
+        ## An endpoint that answers with plain JSON instead returns (response, None)
+        headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+        headers.update(self.auth_headers(force_refresh))
+        response = self.session.post(self.endpoint, headers=headers, data=body.encode('utf-8'), timeout=self.timeout, stream=True)
+        if response.status_code != 200 or not response.headers.get('Content-Type', '').startswith('text/event-stream'):
+            return response, None
+        chunks = []
+        try:
+            for line in response.iter_lines():
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip()
+                if data == b'[DONE]':
+                    break
+                for choice in json.loads(data).get('choices') or []:
+                    delta = (choice.get('delta') or {}).get('content')
+                    if delta:
+                        chunks.append(delta)
+                        if '>' in delta:
+                            on_text(''.join(chunks))
+        finally:
+            response.close()
+        return response, ''.join(chunks)
+
+    async def query(self, transcript, temp=0., max_tokens=512, on_text=None):
+        data = {
+            'model': 'gpt-4o',
+            'max_tokens':max_tokens,
+            'temperature': temp,
+            'top_p': 0.5,
+            'messages':transcript
+        }
+        body = serialize_body(data)
+        self.queries += 1
+        est_tokens = transcript_tokens(transcript)
+        self.est_tokens_total += est_tokens
+        self.max_est_tokens = max(self.max_est_tokens, est_tokens)
+        est_tokens += max_tokens
+
+        with trace.span('gpt.query', bytes=len(body), est_tokens=est_tokens-max_tokens, temperature=temp) as span:
+            cache_key = self.cache.key(body) if self.cache is not None else None
+            if self.cache is not None and self.cache_mode in ('on', 'replay'):
+                response_text = self.cache.get(cache_key)
+                if response_text is not None:
+                    span.set(cache_hit=1)
+                    print(response_text)
+                    return response_text
+                if self.cache_mode == 'replay':
+                    raise gpt_error('no recorded gpt response for request %s'%cache_key)
+
+            if on_text is not None:
+                ## same request with "stream": true prepended, without serializing the messages again
+                stream_body = '{"stream": true, '+body[1:]
+                loop = asyncio.get_running_loop()
+                notify = lambda text: loop.call_soon_threadsafe(on_text, text)
+            response, force_refresh, last_error = None, False, None
+            for attempt in range(self.max_retries+1):
+                span.set(retries=attempt)
+                if attempt:
+                    await asyncio.sleep(self.backoff(attempt-1, response))
+                response = None
+                await self.request_limiter.acquire()
+                await self.token_limiter.acquire(est_tokens)
+                async with self.semaphore():
+                    self.requests_sent += 1
+                    self.bytes_sent += len(body)
+                    self.max_request_bytes = max(self.max_request_bytes, len(body))
+                    streamed_text = None
+                    try:
+                        if on_text is not None and self.streaming:
+                            response, streamed_text = await asyncio.to_thread(self.post_stream, stream_body, force_refresh, notify)
+                        else:
+                            response = await asyncio.to_thread(self.post, body, force_refresh)
+                        force_refresh = False
+                    except Exception as e:
+                        last_error = e
+                        print('gpt request failed (attempt %d): %s'%(attempt+1, e))
+                        continue
+                span.set(status=response.status_code)
+                if response.status_code == 401 and not self.api_key:
+                    last_error, force_refresh = 'status 401', True
+                    continue
+                if response.status_code in self.retry_status:
+                    last_error = 'status %d'%response.status_code
+                    continue
+                if response.status_code == 400 and on_text is not None and self.streaming:
+                    ## endpoint refuses "stream": fall back to whole responses for the rest of the run
+                    print('gpt streaming rejected, falling back to non-streaming requests: %s'%response.text[:200])
+                    last_error, self.streaming = 'status 400', False
+                    continue
+                if response.status_code != 200:
+                    raise gpt_error('gpt request rejected with status %d: %s'%(response.status_code, response.text[:500]))
+                if streamed_text is not None:
+                    response_text, response_json = streamed_text, {}
+                    self.streamed += 1
+                    span.set(streamed=1)
+                else:
+                    try:
+                        response_json = response.json()
+                        response_text = response_json["choices"][0]["message"]["content"] or ''
+                    except (ValueError, KeyError, IndexError) as e:
+                        last_error = 'malformed response: %s'%e
+                        continue
+                if len(response_text)<2:
+                    last_error = 'empty response'
+                    continue
+                print(response_text)
+                usage = response_json.get("usage") or {}
+                span.set(prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0))
+                if self.cache is not None:
+                    self.cache.put(cache_key, response_text, temp)
+                return response_text
+            raise gpt_error('gpt request failed after %d attempts: %s'%(self.max_retries+1, last_error))
+
+    def stats(self):
+        return 'gpt requests: %d sent (%d streamed), %.1f MB total, %.1f KB avg, %.1f KB max payload, ~%d avg / ~%d max prompt tokens'%(
+            self.requests_sent, self.streamed, self.bytes_sent/1024/1024, self.bytes_sent/1024/max(self.requests_sent,1), self.max_request_bytes/1024,
+            self.est_tokens_total/max(self.queries,1), self.max_est_tokens)
+
+gpt = None
+
+async def gptv_query(transcript=None, temp=0., on_text=None):
+    return await gpt.query(transcript if transcript is not None else [], temp=temp, on_text=on_text)
+
+def split_prompts(response, partial=False):
+    ## prompts wrapped with <START> and <END>; partial=True keeps only the ones already closed
+    ## in a response that is still being streamed, giving the same strings as the final split
+    prompts = response.split('<START>')[1:]
+    if partial and prompts and '<END>' not in prompts[-1]:
+        prompts = prompts[:-1]
+    return [x.strip().split('<END>')[0] for x in prompts]
 
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def prompt_listener(on_prompts):
+    return (lambda text: on_prompts(split_prompts(text, partial=True))) if on_prompts is not None else None
+
+class image_prep():
+    ## decodes an image once, shrinks it to what the requested detail level actually uses and
+    ## re-encodes it in memory; fmt='raw' sends the file bytes untouched. The format is always
+    ## sniffed from the content, never from the file name.
+    def __init__(self, detail="low", max_side=None, fmt="jpeg", quality=85):
+        self.detail = detail
+        self.max_side = max_side
+        self.fmt = fmt
+        self.quality = quality
+        self.bytes_in, self.bytes_out = 0, 0
+        self.lock = threading.Lock()
+
+    def tag(self):
+        return '%s|%s|%s|%d'%(self.detail, self.max_side, self.fmt, self.quality)
+
+    def target_size(self, size):
+        ## an explicit max_side bounds the longest side (0 keeps full resolution); otherwise the size is
+        ## what the service keeps at the detail level: low detail is a single 512px view, high/auto fit
+        ## the image into 2048px and then scale its short side down to 768px
+        width, height = size
+        if self.max_side is not None:
+            scale = self.max_side/max(width, height) if self.max_side else 1.
+        elif self.detail == 'low':
+            scale = 512./max(width, height)
+        else:
+            scale = min(2048./max(width, height), 768./min(width, height))
+        if scale >= 1.:
+            return size
+        return (max(1, round(width*scale)), max(1, round(height*scale)))
+
+    def __call__(self, image_path, image=None):
+        with trace.span('image.encode') as span:
+            url, raw_bytes = self.encode(image_path, image)
+            span.set(bytes_in=raw_bytes, bytes_out=len(url))
+        return url
+
+    def encode(self, image_path, image=None):
+        ## an already decoded `image` is encoded directly, without touching image_path on disk
+        if image is None:
+            with open(image_path, "rb") as image_file:
+                raw = image_file.read()
+            image = Image.open(io.BytesIO(raw))
+        else:
+            raw, image = b'', image.copy()
+        src_format = image.format
+        raw_mime = Image.MIME.get(src_format, 'image/png')
+        target = self.target_size(image.size)
+        resize = target != image.size
+        if self.fmt == 'raw' and raw:
+            data, mime = raw, raw_mime
+        elif self.fmt == 'raw':
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            data, mime = buffer.getvalue(), 'image/png'
+        else:
+            if resize:
+                image = image.resize(target, Image.LANCZOS)
+            if self.fmt == 'jpeg' and image.mode != 'RGB':
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                image = image.convert('RGBA')
+                background.paste(image, mask=image.split()[-1])
+                image = background
+            buffer = io.BytesIO()
+            image.save(buffer, format=self.fmt.upper(), quality=self.quality)
+            data, mime = buffer.getvalue(), 'image/%s'%self.fmt
+            if not resize and raw and len(raw) <= len(data) and src_format in ('JPEG', 'PNG', 'WEBP'):
+                data, mime = raw, raw_mime ## already small enough as stored
+        url = 'data:%s;base64,%s'%(mime, base64.b64encode(data).decode('utf-8'))
+        with self.lock:
+            self.bytes_in += len(raw)
+            self.bytes_out += len(url)
+        return url, len(raw)
+
+    def stats(self):
+        return 'image prep: %.1f MB read, %.1f MB encoded'%(self.bytes_in/1024/1024, self.bytes_out/1024/1024)
+
+class image_cache():
+    ## encoded data urls keyed on (path, mtime, size, prep settings), LRU evicted under a byte budget,
+    ## with an optional on-disk tier shared across runs
+    def __init__(self, max_bytes=256*1024*1024, disk_dir=None, prep=None):
+        self.prep = prep if prep is not None else image_prep()
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.disk_hits, self.misses, self.evictions = 0, 0, 0, 0
+        self.lock = threading.Lock()
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def key(self, image_path):
+        stat = os.stat(image_path)
+        return '%s|%d|%d|%s'%(os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size, self.prep.tag())
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()+'.b64')
+
+    def get(self, image_path, image=None, version=None):
+        ## images still held in memory by an artifact_store are keyed on path and the store's version
+        ## number instead of file stat
+        key = self.key(image_path) if image is None else 'mem|%s|%d|%s'%(os.path.abspath(image_path), version, self.prep.tag())
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        value = None
+        if self.disk_dir is not None and image is None and os.path.exists(self.disk_path(key)):
+            with open(self.disk_path(key), 'r') as f:
+                value = f.read()
+            with self.lock:
+                self.disk_hits += 1
+        if value is None:
+            value = self.prep(image_path, image)
+            with self.lock:
+                self.misses += 1
+            if self.disk_dir is not None and image is None:
+                tmp_path = '%s.%d.%d.tmp'%(self.disk_path(key), os.getpid(), threading.get_ident())
+                with open(tmp_path, 'w') as f:
+                    f.write(value)
+                os.replace(tmp_path, self.disk_path(key))
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = len(value)
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= len(self.entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        return 'image cache: %d hits, %d disk hits, %d misses, %d evictions, %d entries, %.1f MB'%(
+            self.hits, self.disk_hits, self.misses, self.evictions, len(self.entries), self.nbytes/1024/1024)
+
+img_cache = image_cache()
 
 def load_img(image_path):
-    base64_image = encode_image(image_path)
-    image_meta = "data:image/png;base64" if 'png' in image_path else "data:image/jpeg;base64"
+    store = current_artifacts.get()
+    image, version = store.get_versioned(image_path) if store is not None else (None, None)
     img_dict = {
         "type": "image_url",
         "image_url": {
-          "url": f"{image_meta},{base64_image}",
-          "detail": "low"
+          "url": img_cache.get(image_path, image, version),
+          "detail": img_cache.prep.detail
         }
     }
     return img_dict
 
-def prepare_fewshot_textreflection(user_prompt, img_prompt, round_best, listofimages, image_history, prompt_history, reflection_history, args):
+async def load_img_async(image_path):
+    ## a cache miss decodes, resizes and re-encodes (tens of ms): keep that off the event loop
+    return await asyncio.to_thread(load_img, image_path)
+
+@functools.lru_cache(maxsize=None)
+def prepare_fewshot_textreflection():
     transcript = []
     transcript.append("Here are some examples:\n")
     ## Example 1
@@ -134,9 +700,10 @@ def prepare_fewshot_textreflection(user_prompt, img_prompt, round_best, listofim
     transcript.append("\n\n###\n\n")
 
     transcript.append("(END OF EXAMPLES)]\n Here is the sample to analyze:\n")
-    return transcript
+    return frozen_parts(transcript)
 
-def prepare_fewshot_selectbest(user_prompt, img_prompt, listofimages, args):
+@functools.lru_cache(maxsize=None)
+def prepare_fewshot_selectbest():
     transcript = []
 
     transcript.append("Here are some examples:\n")
@@ -161,87 +728,171 @@ def prepare_fewshot_selectbest(user_prompt, img_prompt, listofimages, args):
     transcript.append("\n\n###\n\n")
 
     transcript.append("(END OF EXAMPLES)]\n Here is the sample to analyze:\n")
-    return transcript
+    return frozen_parts(transcript)
+
+
+@functools.lru_cache(maxsize=None)
+def system_prompt_init():
+    return frozen_parts([
+        "You are a helpful assistant.\n\nInstruction: Given a user imagined IDEA of the scene, converting the IDEA into a self-contained sentence prompt that will be used to generate an image.\n",
+        "Here are some rules to write good prompts:\n",
+        "- Each prompt should consist of a description of the scene followed by modifiers divided by commas.\n- The modifiers should alter the mood, style, lighting, and other aspects of the scene.\n- Multiple modifiers can be used to provide more specific details.\n- When generating prompts, reduce abstract psychological and emotional descriptions.\n- When generating prompts, explain images and unusual entities in IDEA with detailed descriptions of the scene.\n- Do not mention 'given image' in output, use detailed texts to describe the image in IDEA instead.\n- Generate diverse prompts.\n- Each prompt should have no more than 50 words.\n",
+    ])
+
+@functools.lru_cache(maxsize=None)
+def system_prompt_selectbest():
+    return frozen_parts([
+        "From scale 1 to 10, decide how similar each image is to the user imagined IDEA of the scene.",
+    ])
 
+@functools.lru_cache(maxsize=None)
+def system_prompt_textreflection():
+    return frozen_parts([
+        "You are a helpful assistant.\n\nYou are iteratively refining the sentence prompt by analyzing the images produced by an AI art generation model, seeking to find out the differences between the user imagined IDEA of the scene and the actual output.\n",
+        "If the generated image is not perfect, provide key REASON on ways to improve the image and sentence prompt to better follow the user imagined IDEA of the scene. Here are some rules to write good key REASON:\n",
+        "- Carefully compare the current image with the IDEA to strictly follow the details described in the IDEA, including object counts, attributes, entities, relationships, sizes, and appearance. Write down what is different in detail.\n- Avoid hallucinating information or asks that is not mentioned in IDEA.\n- Explain images and unusual entities in IDEA with detailed text descriptions of the scene.\n- Explain how to modify prompts to address the given reflection reason.\n- Focus on one thing to improve in each REASON. \n- Avoid generating REASON identical with the REASON in previous rounds.\n",
+    ])
 
-def gptv_init_prompt(user_prompt, img_prompt, idea_transcript, args):
+@functools.lru_cache(maxsize=None)
+def system_prompt_revision():
+    return frozen_parts([
+        "You are a helpful assistant.\n\nInstruction: Given a user imagined IDEA of the scene, converting the IDEA into a sentence prompt that will be used to generate an image.\n",
+        "Here are some rules to write good prompts:\n",
+        "- Each prompt should consist of a description of the scene followed by modifiers divided by commas.\n- The modifiers should alter the mood, style, lighting, spatial details, and other aspects of the scene.\n- Multiple modifiers can be used to provide more specific details.\n- When generating prompts, reduce abstract psychological and emotional descriptions.\n- When generating prompts, explain images and unusual entities in IDEA with detailed descriptions of the scene.\n- Do not mention 'given image' in output, use detailed texts to describe the image in IDEA.\n- Generate diverse prompts.\n- Output prompt should have less than 50 words.\n",
+    ])
+
+
+@traced('gpt.init')
+async def gptv_init_prompt(user_prompt, img_prompt, idea_transcript, args, on_prompts=None):
     transcript = [{ "role": "system", "content": [] }, {"role": "user", "content": []}]
     # System prompt
-    transcript[0]["content"].append("You are a helpful assistant.\n\nInstruction: Given a user imagined IDEA of the scene, converting the IDEA into a self-contained sentence prompt that will be used to generate an image.\n")
-    transcript[0]["content"].append("Here are some rules to write good prompts:\n")
-    transcript[0]["content"].append("- Each prompt should consist of a description of the scene followed by modifiers divided by commas.\n- The modifiers should alter the mood, style, lighting, and other aspects of the scene.\n- Multiple modifiers can be used to provide more specific details.\n- When generating prompts, reduce abstract psychological and emotional descriptions.\n- When generating prompts, explain images and unusual entities in IDEA with detailed descriptions of the scene.\n- Do not mention 'given image' in output, use detailed texts to describe the image in IDEA instead.\n- Generate diverse prompts.\n- Each prompt should have no more than 50 words.\n")
+    transcript[0]["content"].append(system_prompt_init())
 
     ## Example & Query prompt
-    transcript[-1]["content"] = transcript[-1]["content"] + idea_transcript
+    transcript[-1]["content"].append(idea_transcript)
     transcript[-1]["content"].append("Based on the above information, you will write %d detailed prompts exactly about the IDEA follow the rules. Each prompt is wrapped with <START> and <END>.\n"%args.num_prompt)
 
-    response = gptv_query(transcript)
+    response = await gptv_query(transcript, on_text=prompt_listener(on_prompts))
     if '<START>' not in response or '<END>' not in response: ## one format retry
-        response = gptv_query(transcript, temp=0.1)
+        response = await gptv_query(transcript, temp=0.1, on_text=prompt_listener(on_prompts))
     if args.verbose:
         print('gptv_init_prompt    IDEA: %s.\n %s\n'%(user_prompt,response))
-    prompts = response.split('<START>')[1:]
-    prompts = [x.strip().split('<END>')[0] for x in prompts]
-    return prompts
+    return split_prompts(response)
 
-def gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, listofimages, args):
+@traced('gpt.select')
+async def gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, listofimages, args):
     num_img = len(listofimages)
     transcript = [{ "role": "system", "content": [] }, {"role": "user", "content": []}]
     # System prompt
     transcript[0]["content"].append("You are a helpful assistant.\n\nYou are a judge to rank provided images. Below are %d images generated by an AI art generation model, indexed from 0 to %d."%(num_img,num_img-1))
-    transcript[0]["content"].append("From scale 1 to 10, decide how similar each image is to the user imagined IDEA of the scene.")
+    transcript[0]["content"].append(system_prompt_selectbest())
 
     ## Example & Query prompt
     if args.select_fewshot:
-        transcript[-1]["content"] = transcript[-1]["content"] + prepare_fewshot_selectbest(user_prompt, img_prompt, listofimages, args)
+        transcript[-1]["content"].append(await asyncio.to_thread(prepare_fewshot_selectbest))
 
-    transcript[-1]["content"] = transcript[-1]["content"] + idea_transcript
+    transcript[-1]["content"].append(idea_transcript)
+    images = await asyncio.gather(*[load_img_async(x) for x in listofimages])
     for img_i in range(num_img):
         transcript[-1]["content"].append("%d. "%img_i)
-        transcript[-1]["content"].append(load_img(listofimages[img_i]))
+        transcript[-1]["content"].append(images[img_i])
 
-    transcript[-1]["content"].append("Let's think step by step. Check all aspects to see how well these images strictly follow the content in IDEA, including having correct object counts, attributes, entities, relationships, sizes, appearance, and all other descriptions in the IDEA. Then give a score for each input images. Finally, consider the scores and select the image with the best overall quality with image index 0 to %d wrapped with <START> and <END>. Only wrap single image index digits between <START> and <END>."%(num_img-1))
+    transcript[-1]["content"].append("Let's think step by step. Check all aspects to see how well these images strictly follow the content in IDEA, including having correct object counts, attributes, entities, relationships, sizes, appearance, and all other descriptions in the IDEA. Then give a score for each input images, one line per image in the form \"Image i: <comments> Overall score: N\" with N from 1 to 10. Finally, consider the scores and select the image with the best overall quality with image index 0 to %d wrapped with <START> and <END>. Only wrap single image index digits between <START> and <END>."%(num_img-1))
 
-    response = gptv_query(transcript)
+    response = await gptv_query(transcript)
     if '<START>' not in response or '<END>' not in response: ## one format retry
-        response = gptv_query(transcript, temp=0.1)
+        response = await gptv_query(transcript, temp=0.1)
     if args.verbose:
         print('gptv_reflection_prompt_selectbest\n %s\n'%(response))
+    scores = parse_scores(response, num_img)
+    fallback = scores.index(max(scores, key=lambda x: -1 if x is None else x)) if any(x is not None for x in scores) else random.randint(0,num_img-1)
     if '<START>' not in response or '<END>' not in response:
-        return random.randint(0,num_img-1), response
+        return fallback, response, scores
     prompts = response.split('<START>')[1]
-    prompts = prompts.strip().split('<END>')[0]
-    return int(prompts) if prompts.isdigit() else random.randint(0,num_img-1), response
+    prompts = prompts.strip().split('<END>')[0].strip()
+    return int(prompts) if prompts.isdigit() and int(prompts)<num_img else fallback, response, scores
+
+def parse_scores(response, num_img):
+    ## per image "Overall score: N" of a select response, None where the judge gave none. Tolerates
+    ## case, markdown bold ("**Image 0**:", "**Overall Score:** 8") and a "/10" suffix
+    scores = [None]*num_img
+    headers = list(re.finditer(r'(?:\*\*)?Image\s*#?(\d+)(?:\*\*)?\s*:', response, re.IGNORECASE))
+    for ii, header in enumerate(headers):
+        segment = response[header.end():headers[ii+1].start() if ii+1 < len(headers) else len(response)]
+        score = re.search(r'Overall\s+score\s*(?:\*\*)?\s*:\s*(?:\*\*)?\s*(\d+(?:\.\d+)?)(?:\s*/\s*10)?', segment, re.IGNORECASE)
+        img_i = int(header.group(1))
+        if score is not None and img_i < num_img:
+            scores[img_i] = float(score.group(1))
+    return scores
+
+def should_stop(score_history, args):
+    ## adaptive round budget: stop refining once the selected image scores high enough ('threshold'),
+    ## or the best score has not improved over the last --plateau_rounds rounds ('plateau')
+    if len(score_history) < max(args.min_rounds,1):
+        return None
+    if score_history[-1] is not None and score_history[-1] >= args.score_threshold:
+        return 'threshold'
+    if args.plateau_rounds > 0 and len(score_history) > args.plateau_rounds:
+        before = [x for x in score_history[:-args.plateau_rounds] if x is not None]
+        recent = [x for x in score_history[-args.plateau_rounds:] if x is not None]
+        if before and recent and max(recent) <= max(before):
+            return 'plateau'
+    return None
+
+async def history_transcript(image_history, prompt_history, reflection_history, args):
+    ## previous rounds, all but the current one. With compaction only the last --history_images rounds
+    ## keep their image; older rounds collapse into a text digest, and rounds are dropped from the
+    ## digest oldest first until the block fits in --history_budget estimated tokens.
+    num_prev = len(image_history)-1
+    keep = num_prev if args.history_images < 0 else min(args.history_images, num_prev)
+    start = 0
+    while True:
+        content = []
+        if start > 0:
+            content.append("(Rounds 1 to %d omitted.)\n"%start)
+        if num_prev-keep > start:
+            content.append("Digest of earlier rounds, images omitted:\n" + ''.join("Round %d: Generated sentence prompt: %s However, %s.\n"%(rounds+1,prompt_history[rounds],reflection_history[rounds]) for rounds in range(start,num_prev-keep)))
+        for rounds in range(num_prev-keep,num_prev):
+            content.append("Round %d:\nGenerated sentence prompt: %s\nCorresponding image generated by the AI art generation model:"%(rounds+1,prompt_history[rounds]))
+            content.append(await load_img_async(image_history[rounds]))
+            content.append("However, %s."%(reflection_history[rounds]))
+        if args.history_budget <= 0 or estimate_tokens(content) <= args.history_budget:
+            return content
+        if keep > 0:
+            keep -= 1
+        elif start < num_prev:
+            start += 1
+        else:
+            return content
+
+def transcript_tokens(transcript):
+    return sum(estimate_tokens(message["content"]) for message in transcript)
 
-def gptv_reflection_prompt_textreflection(user_prompt, img_prompt, idea_transcript, round_best, listofimages, image_history, prompt_history, reflection_history, args):
+@traced('gpt.reflect')
+async def gptv_reflection_prompt_textreflection(user_prompt, img_prompt, idea_transcript, round_best, listofimages, image_history, prompt_history, reflection_history, args):
     current_round = len(image_history)
     transcript = [{ "role": "system", "content": [] }, {"role": "user", "content": []}]
     # System prompt
-    transcript[0]["content"].append("You are a helpful assistant.\n\nYou are iteratively refining the sentence prompt by analyzing the images produced by an AI art generation model, seeking to find out the differences between the user imagined IDEA of the scene and the actual output.\n")
-    transcript[0]["content"].append("If the generated image is not perfect, provide key REASON on ways to improve the image and sentence prompt to better follow the user imagined IDEA of the scene. Here are some rules to write good key REASON:\n")
-    transcript[0]["content"].append("- Carefully compare the current image with the IDEA to strictly follow the details described in the IDEA, including object counts, attributes, entities, relationships, sizes, and appearance. Write down what is different in detail.\n- Avoid hallucinating information or asks that is not mentioned in IDEA.\n- Explain images and unusual entities in IDEA with detailed text descriptions of the scene.\n- Explain how to modify prompts to address the given reflection reason.\n- Focus on one thing to improve in each REASON. \n- Avoid generating REASON identical with the REASON in previous rounds.\n")
+    transcript[0]["content"].append(system_prompt_textreflection())
     ## Example & Query prompt
     if args.fewshot:
-        transcript[-1]["content"] = transcript[-1]["content"] + prepare_fewshot_textreflection(user_prompt, img_prompt, round_best, listofimages, image_history, prompt_history, reflection_history, args)
-    transcript[-1]["content"] = transcript[-1]["content"] + idea_transcript
+        transcript[-1]["content"].append(await asyncio.to_thread(prepare_fewshot_textreflection))
+    transcript[-1]["content"].append(idea_transcript)
 
     transcript[-1]["content"].append("This is the round %d of the iteration.\n")
     if current_round!=1:
         transcript[-1]["content"].append("The iteration history are:\n")
-        for rounds in range(0,len(image_history)-1):
-            transcript[-1]["content"].append("Round %d:\nGenerated sentence prompt: %s\nCorresponding image generated by the AI art generation model:"%(rounds+1,prompt_history[rounds]))
-            transcript[-1]["content"].append(load_img(image_history[rounds]))
-            transcript[-1]["content"].append("However, %s."%(reflection_history[rounds]))
+        transcript[-1]["content"] += await history_transcript(image_history, prompt_history, reflection_history, args)
     transcript[-1]["content"].append("Generated sentence prompt for current round %d is: %s\nCorresponding image generated by the AI art generation model:"%(current_round,prompt_history[-1]))
-    transcript[-1]["content"].append(load_img(image_history[-1]))
+    transcript[-1]["content"].append(await load_img_async(image_history[-1]))
 
     transcript[-1]["content"].append("Based on the above information, you will write REASON that is wrapped with <START> and <END>.\n REASON: ")
 
-    response = gptv_query(transcript)
+    response = await gptv_query(transcript)
     if '<START>' not in response or '<END>' not in response: ## one format retry
-        response = gptv_query(transcript, temp=0.1)
+        response = await gptv_query(transcript, temp=0.1)
     if args.verbose:
-        print('gptv_reflection_prompt_textreflection\n %s\n'%(response))
+        print('gptv_reflection_prompt_textreflection (~%d prompt tokens)\n %s\n'%(transcript_tokens(transcript),response))
     # return response
     if '<START>' not in response or '<END>' not in response:
         return response
@@ -249,147 +900,972 @@ def gptv_reflection_prompt_textreflection(user_prompt, img_prompt, idea_transcri
     prompts = prompts.strip().split('<END>')[0]
     return prompts
 
-def gptv_revision_prompt(user_prompt, img_prompt, idea_transcript, image_history, prompt_history, reflection_history, args):
+@traced('gpt.revise')
+async def gptv_revision_prompt(user_prompt, img_prompt, idea_transcript, image_history, prompt_history, reflection_history, args, on_prompts=None):
     current_round = len(image_history)
     transcript = [{ "role": "system", "content": [] }, {"role": "user", "content": []}]
     # System prompt
-    transcript[0]["content"].append("You are a helpful assistant.\n\nInstruction: Given a user imagined IDEA of the scene, converting the IDEA into a sentence prompt that will be used to generate an image.\n")
-    transcript[0]["content"].append("Here are some rules to write good prompts:\n")
-    transcript[0]["content"].append("- Each prompt should consist of a description of the scene followed by modifiers divided by commas.\n- The modifiers should alter the mood, style, lighting, spatial details, and other aspects of the scene.\n- Multiple modifiers can be used to provide more specific details.\n- When generating prompts, reduce abstract psychological and emotional descriptions.\n- When generating prompts, explain images and unusual entities in IDEA with detailed descriptions of the scene.\n- Do not mention 'given image' in output, use detailed texts to describe the image in IDEA.\n- Generate diverse prompts.\n- Output prompt should have less than 50 words.\n")
+    transcript[0]["content"].append(system_prompt_revision())
     ## Example & Query prompt
-    transcript[-1]["content"] = transcript[-1]["content"] + idea_transcript
+    transcript[-1]["content"].append(idea_transcript)
     transcript[-1]["content"].append("You are iteratively improving the sentence prompt by looking at the images generated by an AI art generation model and find out what is different from the given IDEA.\n")
     transcript[-1]["content"].append("This is the round %d of the iteration.\n"%current_round)
     if current_round!=1:
         transcript[-1]["content"].append("The iteration history are:\n")
-        for rounds in range(0,len(image_history)-1):
-            transcript[-1]["content"].append("Round %d:\nGenerated sentence prompt: %s\nCorresponding image generated by the AI art generation model:"%(rounds+1,prompt_history[rounds]))
-            transcript[-1]["content"].append(load_img(image_history[rounds]))
-            transcript[-1]["content"].append("However, %s."%(reflection_history[rounds]))
+        transcript[-1]["content"] += await history_transcript(image_history, prompt_history, reflection_history, args)
     transcript[-1]["content"].append("Generated sentence prompt for current round %d is: %s\nCorresponding image generated by the AI art generation model:"%(current_round,prompt_history[-1]))
-    transcript[-1]["content"].append(load_img(image_history[-1]))
+    transcript[-1]["content"].append(await load_img_async(image_history[-1]))
     transcript[-1]["content"].append("However, %s."%(reflection_history[-1]))
 
     transcript[-1]["content"].append("Based on the above information, to improve the image, you will write %d detailed prompts exactly about the IDEA follow the rules. Make description of the scene more detailed and add modifiers to address the given key reasons to improve the image. Avoid generating prompts identical with the ones in previous rounds. Each prompt is wrapped with <START> and <END>.\n"%args.num_prompt)
-    response = gptv_query(transcript)
+    response = await gptv_query(transcript, on_text=prompt_listener(on_prompts))
     if '<START>' not in response or '<END>' not in response: ## one format retry
-        response = gptv_query(transcript, temp=0.1)
+        response = await gptv_query(transcript, temp=0.1, on_text=prompt_listener(on_prompts))
     if args.verbose:
-        print('gptv_revision_prompt    IDEA: %s.\n %s\n'%(user_prompt,response))
-    prompts = response.split('<START>')[1:]
-    prompts = [x.strip().split('<END>')[0] for x in prompts]
+        print('gptv_revision_prompt (~%d prompt tokens)    IDEA: %s.\n %s\n'%(transcript_tokens(transcript),user_prompt,response))
+    prompts = split_prompts(response)
     while len(prompts)<args.num_prompt:
         prompts = prompts + ['blank image']
     return prompts
 
-class t2i_sd3():
-    def __init__(self, refiner=False, img2img=True):
-        from diffusers import StableDiffusion3Pipeline, DiffusionPipeline
-        self.refiner = refiner
-        self.img2img = img2img
-        self.pipe = StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers", torch_dtype=torch.float16, use_safetensors=True, variant="fp16")
-        # self.pipe.to("cuda")
-        self.pipe.enable_model_cpu_offload()
-        self.pipe.enable_xformers_memory_efficient_attention()
-        self.pipe.set_progress_bar_config(disable=True)
-        if self.refiner:
-            self.refine_pipe = DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-refiner-1.0",text_encoder_2=self.pipe.text_encoder_2,vae=self.pipe.vae,torch_dtype=torch.float16,use_safetensors=True,variant="fp16",)
-            # self.pipe.to("cuda")
-            self.refine_pipe.enable_model_cpu_offload()
-            self.refine_pipe.enable_xformers_memory_efficient_attention()
-            self.refine_pipe.set_progress_bar_config(disable=True)
-        if self.img2img:
-            # from diffusers import StableDiffusionXLImg2ImgPipeline
-            self.img2img_pipe = StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers", torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
-            # self.pipe.to("cuda")
-            self.img2img_pipe.enable_model_cpu_offload()
-            self.img2img_pipe.enable_xformers_memory_efficient_attention()
-            self.img2img_pipe.set_progress_bar_config(disable=True)            
+def t2i_batch_cap(image_mem_gb, batch_size=0):
+    ## largest batch that fits in free device memory, optionally capped by --t2i_batch_size
+    import torch
+    cap = batch_size if batch_size > 0 else 64
+    if torch.cuda.is_available():
+        free_bytes, _ = torch.cuda.mem_get_info()
+        cap = min(cap, int(free_bytes/(image_mem_gb*1024**3)))
+    return max(cap, 1)
+
+def batched(items, size):
+    return [items[x:x+size] for x in range(0, len(items), size)]
+
+t2i_registry = {}
+
+def register_t2i(name):
+    ## makes a backend selectable as --t2i_model <name>
+    def register(cls):
+        cls.name = name
+        t2i_registry[name] = cls
+        return cls
+    return register
+
+class t2i_base():
+    ## interface shared by all T2I backends. The batched calls return (images, base latents or None);
+    ## a diffusers backend only loads self.pipe, self.img2img_pipe and self.refine_pipe
+    image_mem_gb = 2.0 ## rough device memory per image in a batch
+    has_img2img, has_refiner, has_batch, has_latents = True, True, True, True
+
+    def __init__(self, refiner=False, img2img=True, batch_size=0):
+        self.refiner = refiner and self.has_refiner
+        self.img2img = img2img and self.has_img2img
+        self.batch_size = batch_size
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(refiner=not args.no_refiner, img2img=args.img2img, batch_size=args.t2i_batch_size)
+
+    def capabilities(self):
+        return {'name': self.name, 'image_mem_gb': self.image_mem_gb, 'refiner': self.refiner, 'img2img': self.img2img,
+                'has_img2img': self.has_img2img, 'has_refiner': self.has_refiner, 'has_batch': self.has_batch, 'has_latents': self.has_latents and self.refiner}
+
+    def prepare(self, pipe, phase, xformers=True):
+        # pipe.to("cuda")
+        pipe.enable_model_cpu_offload()
+        if xformers:
+            pipe.enable_xformers_memory_efficient_attention()
+        pipe.set_progress_bar_config(disable=True)
+        startup.mark(phase)
+        return pipe
+
+    def load_refiner(self):
+        import torch
+        from diffusers import DiffusionPipeline
+        self.refine_pipe = self.prepare(DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-refiner-1.0",text_encoder_2=self.pipe.text_encoder_2,vae=self.pipe.vae,torch_dtype=torch.float16,use_safetensors=True,variant="fp16",), 'refiner')
+
+    def batch_cap(self):
+        return t2i_batch_cap(self.image_mem_gb, self.batch_size) if self.has_batch else 1
+
+    def base(self, prompts):
+        return self.pipe(prompts,output_type="latent" if self.refiner else "pil").images
+
+    def base_img2img(self, image, prompts, strength):
+        ## `image` is a PIL image, or a base latent of shape (1,C,H,W) which skips the VAE encode
+        init = image.repeat(len(prompts),1,1,1) if hasattr(image, 'shape') else [image]*len(prompts)
+        return self.img2img_pipe(prompt=prompts, image=init, strength=strength, output_type="latent" if self.refiner else "pil").images
+
+    def generate(self, run, prompts, savenames, return_latents):
+        ## with the refiner the base outputs are latents: keep them and refine them into the images
+        images, latents = [], []
+        for chunk in batched(prompts, self.batch_cap()):
+            base = run(chunk)
+            if self.refiner:
+                latents += [x.detach().cpu() for x in base]
+                base = self.refine_pipe(prompt=chunk, image=base).images
+            images += base
+        if savenames is not None:
+            for image, savename in zip(images, savenames):
+                image.save(savename)
+        return images, latents if return_latents and self.refiner else None
 
     def inference(self,prompt,savename):
-        image = self.pipe(prompt,output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
+        self.inference_batch([prompt], [savename])
     def img2img_inference(self,image,prompt,savename,strength=1.0):
-        image = self.img2img_pipe(prompt=prompt, image=image, strength=strength, output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
-
-class t2i_fluxdev():
-    def __init__(self, refiner=False, img2img=True):
-        from diffusers import FluxPipeline
-        self.refiner = refiner
-        self.img2img = img2img
-        self.pipe = FluxPipeline.from_pretrained("black-forest-labs/FLUX.1-dev", torch_dtype=torch.float16, use_safetensors=True, variant="fp16")
-        # self.pipe.to("cuda")
-        self.pipe.enable_model_cpu_offload()
-        self.pipe.enable_xformers_memory_efficient_attention()
-        self.pipe.set_progress_bar_config(disable=True)
-        # if self.refiner:
-        #     self.refine_pipe = DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-refiner-1.0",text_encoder_2=self.pipe.text_encoder_2,vae=self.pipe.vae,torch_dtype=torch.float16,use_safetensors=True,variant="fp16",)
-        #     # self.pipe.to("cuda")
-        #     self.refine_pipe.enable_model_cpu_offload()
-        #     self.refine_pipe.enable_xformers_memory_efficient_attention()
-        #     self.refine_pipe.set_progress_bar_config(disable=True)
+        self.img2img_inference_batch(image, [prompt], [savename], strength=strength)
+    def inference_batch(self,prompts,savenames=None,return_latents=False):
+        return self.generate(self.base, prompts, savenames, return_latents)
+    def img2img_inference_batch(self,image,prompts,savenames=None,strength=1.0,return_latents=False):
+        return self.generate(lambda chunk: self.base_img2img(image, chunk, strength), prompts, savenames, return_latents)
+
+@register_t2i('sd3')
+class t2i_sd3(t2i_base):
+    image_mem_gb = 2.0
+    has_refiner = False ## the SDXL refiner cannot take SD3's 16-channel latents
+    def __init__(self, refiner=False, img2img=True, batch_size=0):
+        super().__init__(refiner, img2img, batch_size)
+        import torch
+        from diffusers import StableDiffusion3Pipeline, StableDiffusion3Img2ImgPipeline
+        startup.mark('import torch/diffusers')
+        self.pipe = self.prepare(StableDiffusion3Pipeline.from_pretrained("stabilityai/stable-diffusion-3-medium-diffusers", torch_dtype=torch.float16, use_safetensors=True, variant="fp16"), 'sd3 base')
         if self.img2img:
-            from diffusers import FluxPipeline
-            self.img2img_pipe = FluxPipeline.from_pretrained("black-forest-labs/FLUX.1-dev", torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
-            # self.pipe.to("cuda")
-            self.img2img_pipe.enable_model_cpu_offload()
-            self.img2img_pipe.enable_xformers_memory_efficient_attention()
-            self.img2img_pipe.set_progress_bar_config(disable=True)            
+            ## shares the already loaded transformer, text encoders and vae
+            self.img2img_pipe = self.prepare(StableDiffusion3Img2ImgPipeline.from_pipe(self.pipe), 'sd3 img2img', xformers=False)
 
-    def inference(self,prompt,savename):
-        image = self.pipe(prompt,output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
-    def img2img_inference(self,image,prompt,savename,strength=1.0):
-        image = self.img2img_pipe(prompt=prompt, image=image, strength=strength, output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
-class t2i_sdxl():
-    def __init__(self, refiner=False, img2img=True):
-        from diffusers import DiffusionPipeline
-        self.refiner = refiner
-        self.img2img = img2img
-        self.pipe = DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, use_safetensors=True, variant="fp16")
-        # self.pipe.to("cuda")
-        self.pipe.enable_model_cpu_offload()
-        self.pipe.enable_xformers_memory_efficient_attention()
-        self.pipe.set_progress_bar_config(disable=True)
+@register_t2i('fluxdev')
+class t2i_fluxdev(t2i_base):
+    image_mem_gb = 3.0
+    has_refiner = False ## no refiner for flux
+    def __init__(self, refiner=False, img2img=True, batch_size=0):
+        super().__init__(refiner, img2img, batch_size)
+        import torch
+        from diffusers import FluxPipeline, FluxImg2ImgPipeline
+        startup.mark('import torch/diffusers')
+        self.pipe = self.prepare(FluxPipeline.from_pretrained("black-forest-labs/FLUX.1-dev", torch_dtype=torch.float16, use_safetensors=True, variant="fp16"), 'flux base')
+        if self.img2img:
+            ## shares the already loaded transformer, text encoders and vae
+            self.img2img_pipe = self.prepare(FluxImg2ImgPipeline.from_pipe(self.pipe), 'flux img2img', xformers=False)
+
+@register_t2i('sdxl')
+class t2i_sdxl(t2i_base):
+    image_mem_gb = 1.5
+    def __init__(self, refiner=False, img2img=True, batch_size=0):
+        super().__init__(refiner, img2img, batch_size)
+        import torch
+        from diffusers import DiffusionPipeline, StableDiffusionXLImg2ImgPipeline
+        startup.mark('import torch/diffusers')
+        self.pipe = self.prepare(DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, use_safetensors=True, variant="fp16"), 'sdxl base')
         if self.refiner:
-            self.refine_pipe = DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-refiner-1.0",text_encoder_2=self.pipe.text_encoder_2,vae=self.pipe.vae,torch_dtype=torch.float16,use_safetensors=True,variant="fp16",)
-            # self.pipe.to("cuda")
-            self.refine_pipe.enable_model_cpu_offload()
-            self.refine_pipe.enable_xformers_memory_efficient_attention()
-            self.refine_pipe.set_progress_bar_config(disable=True)
+            self.load_refiner()
         if self.img2img:
-            from diffusers import StableDiffusionXLImg2ImgPipeline
-            self.img2img_pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained("stabilityai/stable-diffusion-xl-base-1.0", torch_dtype=torch.float16, variant="fp16", use_safetensors=True)
-            # self.pipe.to("cuda")
-            self.img2img_pipe.enable_model_cpu_offload()
-            self.img2img_pipe.enable_xformers_memory_efficient_attention()
-            self.img2img_pipe.set_progress_bar_config(disable=True)            
+            ## shares the already loaded unet, text encoders and vae
+            self.img2img_pipe = self.prepare(StableDiffusionXLImg2ImgPipeline.from_pipe(self.pipe), 'sdxl img2img', xformers=False)
+
+def get_sample_name(sample):
+    return sample.split('<IMG>')[0].replace(' ','').replace('.','')
+
+def checkpoint_path(args, sample_name):
+    return 'output/%s/state/%s.json'%(args.foldername,sample_name)
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_checkpoint(path, state):
+    ## write-then-rename, so a crash never leaves a torn checkpoint behind
+    with trace.span('io.checkpoint'):
+        tmp_path = '%s.%s.%d.tmp'%(path, socket.gethostname(), os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+@register_t2i('stub')
+class t2i_stub(t2i_base):
+    ## CPU stand-in: synthetic images and a fixed delay per image, for benchmarking the orchestration
+    ## without a GPU. The "refiner" is a no-op and the "latents" are the images themselves
+    image_mem_gb = 0.
+    def __init__(self, refiner=False, img2img=True, batch_size=0, delay=0.5, size=1024):
+        super().__init__(refiner, img2img, batch_size)
+        self.delay = delay
+        self.size = size
+        startup.mark('stub')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(refiner=not args.no_refiner, img2img=args.img2img, batch_size=args.t2i_batch_size, delay=args.stub_delay)
+
+    def synthesize(self, prompt, base=None):
+        time.sleep(self.delay)
+        seed = int(hashlib.md5(prompt.encode('utf-8')).hexdigest()[:8], 16)
+        rng = random.Random(seed)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.new('RGB', (self.size, self.size), color) if base is None else base.convert('RGB').resize((self.size, self.size))
+        pixels = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(64)]
+        tile = Image.new('RGB', (8, 8))
+        tile.putdata(pixels)
+        image.paste(tile.resize((self.size//2, self.size//2), Image.NEAREST), (self.size//4, self.size//4))
+        return image
+
+    def base(self, prompts):
+        return [self.synthesize(prompt) for prompt in prompts]
+
+    def base_img2img(self, image, prompts, strength):
+        return [self.synthesize(prompt, image) for prompt in prompts]
+
+    def generate(self, run, prompts, savenames, return_latents):
+        images = run(prompts)
+        if savenames is not None:
+            for image, savename in zip(images, savenames):
+                image.save(savename)
+        return images, images if return_latents and self.refiner else None
+
+def t2i_server_key(address, create=False):
+    ## the t2i server unpickles what clients send, so it never runs without a secret: T2I_SERVER_AUTHKEY
+    ## if set, otherwise a random key the server writes to <socket>.key, readable only by its user
+    key = os.environ.get("T2I_SERVER_AUTHKEY")
+    if key:
+        return key.encode('utf-8')
+    path = address+'.key'
+    if create:
+        key = secrets.token_hex(32)
+        tmp_path = '%s.%d.tmp'%(path, os.getpid())
+        fd = os.open(tmp_path, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+        os.replace(tmp_path, path)
+        return key.encode('utf-8')
+    try:
+        with open(path) as f:
+            return f.read().strip().encode('utf-8')
+    except FileNotFoundError:
+        raise RuntimeError('T2I_SERVER_AUTHKEY is not set and there is no key file %s; start the server with --t2i_serve first'%path)
+
+class t2i_server():
+    ## keeps one loaded backend resident and serves it on a local socket, so successive runs and
+    ## concurrent clients share its weights instead of each paying the model load. Jobs of all
+    ## clients run one at a time, like on a gpu_worker
+    methods = ('inference', 'img2img_inference', 'inference_batch', 'img2img_inference_batch')
+
+    def __init__(self, t2i_model, address):
+        self.t2i_model = t2i_model
+        self.address = address
+        self.lock = threading.Lock()
+        self.jobs, self.clients = 0, 0
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.address)
+                raise RuntimeError('a t2i server is already listening on %s'%self.address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.address) ## left behind by a server that died
+            finally:
+                probe.close()
+        ## socket and key file are created owner-only from the start, not chmod-ed afterwards
+        umask = os.umask(0o077)
+        try:
+            authkey = t2i_server_key(self.address, create=True)
+            listener = multiprocessing.connection.Listener(self.address, family='AF_UNIX', authkey=authkey)
+        finally:
+            os.umask(umask)
+        with listener:
+            print('t2i server (%s) listening on %s'%(self.t2i_model.name, self.address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except (multiprocessing.AuthenticationError, OSError) as e:
+                    print('t2i server: rejected connection: %s'%e)
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        self.clients += 1
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if method == 'capabilities':
+                        result = self.t2i_model.capabilities()
+                    elif method in self.methods:
+                        with self.lock:
+                            start = time.perf_counter()
+                            result = getattr(self.t2i_model, method)(*args, **kwargs)
+                            self.jobs += 1
+                        print('t2i server: %s, %.1fs, %d jobs for %d clients so far'%(method, time.perf_counter()-start, self.jobs, self.clients))
+                    else:
+                        raise ValueError('unknown t2i method %s'%method)
+                    conn.send((True, result))
+                except Exception as e:
+                    conn.send((False, '%s: %s'%(type(e).__name__, e)))
+
+@register_t2i('remote')
+class t2i_remote(t2i_base):
+    ## client of a t2i_server started with --t2i_serve: the model, its settings and its
+    ## capabilities are the server's; this process only ships prompts and images
+    def __init__(self, refiner=False, img2img=True, batch_size=0, address='t2i.sock', authkey=b''):
+        self.address, self.authkey = address, authkey
+        self.conn = None
+        info = self.call('capabilities')
+        self.name = 'remote:%s'%info['name']
+        self.image_mem_gb = info['image_mem_gb']
+        self.has_img2img, self.has_refiner, self.has_batch, self.has_latents = info['has_img2img'], info['has_refiner'], info['has_batch'], info['has_latents']
+        self.refiner, self.img2img, self.batch_size = info['refiner'], info['img2img'], batch_size
+        if img2img and not self.img2img:
+            raise RuntimeError('the t2i server on %s was started without --img2img'%address)
+        if refiner != self.refiner:
+            print('t2i server on %s runs %s the refiner'%(address, 'with' if self.refiner else 'without'))
+        startup.mark('connect t2i server')
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(refiner=not args.no_refiner, img2img=args.img2img, batch_size=args.t2i_batch_size, address=args.t2i_socket, authkey=t2i_server_key(args.t2i_socket))
+
+    def call(self, method, *args, **kwargs):
+        for attempt in range(2):
+            try:
+                if self.conn is None:
+                    self.conn = multiprocessing.connection.Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                self.conn.send((method, args, kwargs))
+                ok, result = self.conn.recv()
+                break
+            except (EOFError, OSError):
+                ## server restarted since the last call: reconnect once
+                self.conn = None
+                if attempt:
+                    raise
+        if not ok:
+            raise RuntimeError('t2i server: %s'%result)
+        return result
 
     def inference(self,prompt,savename):
-        image = self.pipe(prompt,output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
+        return self.call('inference', prompt, savename)
     def img2img_inference(self,image,prompt,savename,strength=1.0):
-        image = self.img2img_pipe(prompt=prompt, image=image, strength=strength, output_type="latent").images[0]
-        if self.refiner:
-            image = self.refine_pipe(prompt=prompt, image=image[None, :]).images[0]
-        image.save(savename)
+        return self.call('img2img_inference', image, prompt, savename, strength=strength)
+    def inference_batch(self,prompts,savenames=None,return_latents=False):
+        return self.call('inference_batch', prompts, savenames=savenames, return_latents=return_latents)
+    def img2img_inference_batch(self,image,prompts,savenames=None,strength=1.0,return_latents=False):
+        return self.call('img2img_inference_batch', image, prompts, savenames=savenames, strength=strength, return_latents=return_latents)
+
+class artifact_store():
+    ## one per sample: decoded reference/generated images and base latents stay in memory for the
+    ## sample's lifetime, so nothing is read back from disk; PNGs are written by background threads
+    writer = None
+    versions = itertools.count() ## unique across stores, so a cached encoding never outlives its image
+
+    def __init__(self):
+        self.images, self.latents, self.pending = {}, {}, []
+        self.version = {}
+        if artifact_store.writer is None:
+            artifact_store.writer = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='artifact_io')
+
+    def put(self, path, image, latent=None):
+        self.images[path] = image
+        self.version[path] = next(artifact_store.versions)
+        if latent is not None:
+            self.latents[path] = latent
+        self.pending.append(self.writer.submit(contextvars.copy_context().run, self.write, path, image))
+
+    @staticmethod
+    def write(path, image):
+        with trace.span('io.write_image'):
+            tmp_path = path+'.tmp.png'
+            image.save(tmp_path)
+            os.replace(tmp_path, path)
+
+    def get(self, path):
+        return self.images.get(path)
+
+    def get_versioned(self, path):
+        return self.images.get(path), self.version.get(path)
+
+    def has(self, path):
+        return path in self.images or os.path.exists(path)
+
+    def reference(self, path, size=(1024,1024)):
+        key = ('reference', path, size)
+        if key not in self.images:
+            with trace.span('io.load_reference'):
+                self.images[key] = Image.open(path).convert('RGB').resize(size)
+        return self.images[key]
+
+    def keep_latents(self, paths):
+        self.latents = {k: v for k, v in self.latents.items() if k in paths}
+
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            await asyncio.wrap_future(future)
+
+current_artifacts = contextvars.ContextVar('current_artifacts', default=None)
+
+async def copy_result(image_path, key, sample_name, args):
+    await current_artifacts.get().flush()
+    with trace.span('io.copy'):
+        shutil.copyfile(image_path, 'output/%s/%s/%s.png'%(args.foldername,key,sample_name))
+
+async def generate_images(gpu, store, sample, prompts, savenames, rounds, image_history, args):
+    ## only samples with an input image run img2img, text-only samples stay on T2I every round
+    reuse_latent = args.reuse_latent and args.img2img and '<IMG>' in sample
+    seed = store.latents.get(image_history[-1]) if reuse_latent and rounds > 0 else None
+    if seed is not None:
+        ## start from the previous best's base latent, no VAE decode/encode round trip
+        images, latents = await gpu.img2img_inference_batch(seed[None] if hasattr(seed, 'shape') else seed, prompts, strength=args.strength, return_latents=True)
+    elif args.img2img and '<IMG>' in sample:
+        images, latents = await gpu.img2img_inference_batch(store.reference(sample.split('<IMG>')[1]), prompts, strength=args.strength, return_latents=reuse_latent)
+    else: ## T2I
+        images, latents = await gpu.inference_batch(prompts, return_latents=reuse_latent)
+    for ii, savename in enumerate(savenames):
+        store.put(savename, images[ii], latents[ii] if latents is not None else None)
+
+placeholder_prompts = ('blank image', '')
+
+def normalize_prompt(prompt):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', prompt.lower()).split())
+
+def similar_prompts(a, b, threshold):
+    ## normalized prompts whose word sets overlap by at least `threshold` (Jaccard). Only word-level:
+    ## a one word revision like "red apples" -> "pink apples" is what refinement is for, not a repeat
+    if a == b:
+        return True
+    words_a, words_b = set(a.split()), set(b.split())
+    return bool(words_a and words_b) and len(words_a & words_b)/len(words_a | words_b) >= threshold
+
+def dedup_prompts(prompts, earlier, threshold):
+    ## per prompt of a round: ('generate', None), ('skip', None) for placeholders and near-repeats
+    ## within the round, or ('reuse', (prompt, paths)) for an exact (normalized) repeat of a prompt of an
+    ## earlier round. A decision only depends on the prompts before it, so it does not change while the
+    ## response is still streaming
+    normalized = [normalize_prompt(x) for x in prompts]
+    decisions = []
+    for ii, text in enumerate(normalized):
+        if text in placeholder_prompts or any(similar_prompts(text, x, threshold) for x in normalized[:ii] if x not in placeholder_prompts):
+            decisions.append(('skip', None))
+        elif text in earlier:
+            decisions.append(('reuse', earlier[text]))
+        else:
+            decisions.append(('generate', None))
+    return decisions
+
+def earlier_prompts(records):
+    ## normalized prompt -> (original prompt, image paths) of every prompt that got images in the given rounds
+    earlier = OrderedDict()
+    for record in records:
+        for candidate in record.get('candidates', []):
+            prompt, paths = earlier.setdefault(normalize_prompt(candidate[3]), (candidate[3], []))
+            if candidate[2] not in paths:
+                paths.append(candidate[2])
+    return earlier
+
+def dhash(image, size=8):
+    ## perceptual difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale copy
+    pixels = list(image.convert('L').resize((size+1, size), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = bits<<1 | (pixels[row*(size+1)+col] > pixels[row*(size+1)+col+1])
+    return bits
+
+def dedup_images(candidates, store, max_distance):
+    ## drops candidates whose image is a near-copy of an earlier candidate of the round
+    kept, hashes = [], []
+    for candidate in candidates:
+        image = store.get(candidate[2])
+        image_hash = dhash(image if image is not None else Image.open(candidate[2]))
+        if any(bin(image_hash^x).count('1') <= max_distance for x in hashes):
+            continue
+        kept.append(candidate)
+        hashes.append(image_hash)
+    return kept
+
+class prompt_dispatch():
+    ## with --gpt_stream, starts T2I for each prompt as soon as the streamed response closes it.
+    ## A prompt that differs in the final response (e.g. after a retried request) is generated again.
+    ## keep(prompts[:ii+1]) decides whether prompt ii needs diffusion at all
+    def __init__(self, generate, num_prompt, keep=None):
+        self.generate = generate
+        self.num_prompt = num_prompt
+        self.keep = keep
+        self.jobs = {}
+
+    def __call__(self, prompts):
+        for ii, prompt in enumerate(prompts[:self.num_prompt]):
+            if ii in self.jobs and self.jobs[ii][0] == prompt:
+                continue
+            if ii in self.jobs and self.jobs[ii][1] is not None:
+                self.jobs[ii][1].cancel()
+            keep = self.keep is None or self.keep(prompts[:ii+1])
+            self.jobs[ii] = (prompt, asyncio.ensure_future(self.generate(ii, prompt)) if keep else None)
+
+    async def finish(self, prompts):
+        self(prompts)
+        await asyncio.gather(*[task for prompt, task in self.jobs.values() if task is not None and not task.cancelled()])
+
+async def run_sample(sample, gpu, args):
+    user_prompt, img_prompt = sample, None
+    prompt_list = user_prompt.split('<IMG>')
+    user_prompt = user_prompt.split('<IMG>')[0] ## legacy, for naming use only
+    sample_name = get_sample_name(sample)
+    current_sample.set(sample_name)
+    store = artifact_store()
+    current_artifacts.set(store)
+
+    ## per sample run state, checkpointed after every stage of every round
+    state_path = checkpoint_path(args, sample_name)
+    state = load_checkpoint(state_path) if args.resume else None
+    if state is not None and state['sample'] != sample:
+        state = None
+    if state is not None and state['done']:
+        return state
+    if state is None:
+        state = {'sample': sample, 'done': False, 'rounds': [], 'final': None,
+                 'prompt_history': [], 'select_history': [], 'image_history': [], 'reflection_history': [], 'bestidx_history': [], 'score_history': []}
+
+    idea_transcript = []
+    for ii in range(len(prompt_list)):
+        if ii == 0:
+            idea_transcript.append("IDEA: %s."%prompt_list[0])
+        elif ii%2==1:
+            idea_transcript.append(await load_img_async(prompt_list[ii]))
+        elif ii%2==0:
+            idea_transcript.append("%s"%prompt_list[ii])
+    idea_transcript.append("End of IDEA.\n")
+    idea_transcript = frozen_parts(idea_transcript)
+
+    text_record = 'output/%s/tmp/%s.txt'%(args.foldername,sample_name)
+    os.makedirs('output/%s/tmp/%s'%(args.foldername,sample_name), exist_ok=True)
+
+    ### GPTV prompting iter
+    prompt_history, select_history, image_history, reflection_history, bestidx_history, score_history = state['prompt_history'], state['select_history'], state['image_history'], state['reflection_history'], state['bestidx_history'], state['score_history']
+    for rounds in range(args.max_rounds):
+        if rounds == len(state['rounds']):
+            state['rounds'].append({'stage': 'start'})
+        record = state['rounds'][rounds]
+        if record['stage'] == 'reflected':
+            if record.get('stop'):
+                break
+            continue
+        if args.verbose: print('ROUND %d:\n'%rounds)
+        ###### new rounds' prompt (init/revision)
+        candidates = [(ii,jj) for ii in range(args.num_prompt) for jj in range(args.num_img)]
+        savenames = ['output/%s/tmp/%s/%d_%d_%d.png'%(args.foldername,sample_name,rounds,ii,jj) for ii,jj in candidates]
+        earlier = earlier_prompts(state['rounds'][:rounds]) if args.dedup else {}
+        streamed = False
+        if record['stage'] == 'start':
+            dispatch = None
+            if args.gpt_stream:
+                keep = (lambda prefix: dedup_prompts(prefix, earlier, args.dedup_threshold)[-1][0] == 'generate') if args.dedup else None
+                dispatch = prompt_dispatch(lambda ii, prompt: generate_images(gpu, store, sample, [prompt]*args.num_img, savenames[ii*args.num_img:(ii+1)*args.num_img], rounds, image_history, args), args.num_prompt, keep)
+            if rounds == 0:
+                gptv_prompts = await gptv_init_prompt(user_prompt, None, idea_transcript, args, on_prompts=dispatch)
+            else:
+                gptv_prompts = await gptv_revision_prompt(user_prompt, None, idea_transcript, image_history, prompt_history, reflection_history, args, on_prompts=dispatch)
+            record.update(stage='prompts', prompts=gptv_prompts)
+            save_checkpoint(state_path, state)
+            if dispatch is not None:
+                await dispatch.finish(gptv_prompts)
+                streamed = True
+        current_prompts = record['prompts']
+        ###### dedup: placeholder prompts and repeats within the round get no images, repeats of an earlier round reuse its images
+        planned = [[ii,jj,savename,current_prompts[ii]] for (ii,jj),savename in zip(candidates,savenames)]
+        if args.dedup:
+            decisions = dedup_prompts(current_prompts[:args.num_prompt], earlier, args.dedup_threshold)
+            if all(action == 'skip' for action, paths in decisions):
+                decisions[0] = ('generate', None) ## always leave something to select from
+            planned = []
+            for ii, (action, paths) in enumerate(decisions):
+                if action == 'generate':
+                    planned += [[ii,jj,savenames[ii*args.num_img+jj],current_prompts[ii]] for jj in range(args.num_img)]
+                elif action == 'reuse':
+                    planned += [[ii,jj,path,paths[0]] for jj,path in enumerate(paths[1])]
+        ###### t2i generation: all prompts and variants of the round in one batched job on the shared GPU worker
+        if record['stage'] == 'prompts' or not all(store.has(x[2]) for x in planned):
+            missing = [x for x in planned if x[2] in savenames and ((record['stage'] == 'prompts' and not streamed) or not store.has(x[2]))]
+            if missing:
+                await generate_images(gpu, store, sample, [x[3] for x in missing], [x[2] for x in missing], rounds, image_history, args)
+            if record['stage'] == 'prompts':
+                round_candidates = planned
+                if args.dedup:
+                    with trace.span('dedup') as span:
+                        round_candidates = dedup_images(planned, store, args.dedup_hamming)
+                        span.set(skipped=sum(action == 'skip' for action, paths in decisions), reused=sum(action == 'reuse' for action, paths in decisions), dropped=len(planned)-len(round_candidates))
+                ## the checkpoint must never point at images still queued for writing
+                await store.flush()
+                record.update(stage='generated', candidates=round_candidates)
+                save_checkpoint(state_path, state)
+        round_candidates = record.get('candidates') or planned
+        round_images = [x[2] for x in round_candidates]
+        ###### reflection: first select best, then give reason to improve (i.e., reflection)
+        if record['stage'] == 'generated':
+            round_best, select_response, scores = await gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, round_images, args)
+            best_prompt = round_candidates[round_best][0]
+            ## select the best, give an index. two separate calls
+            prompt_history.append(round_candidates[round_best][3]) ## reused images keep their original prompt
+            select_history.append('Round selection: %d. || '%round_best+select_response)
+            image_history.append(round_images[round_best])
+            bestidx_history.append(best_prompt)
+            score_history.append(scores[round_best])
+            store.keep_latents([round_images[round_best]])
+            ## the adaptive controller may make this the final round: no reflection/revision after it
+            record.update(stage='selected', round_best=round_best, scores=scores, stop=should_stop(score_history, args) if args.adaptive else None)
+            save_checkpoint(state_path, state)
+        if rounds!=args.max_rounds-1 and not record.get('stop'):
+            reflection_text = await gptv_reflection_prompt_textreflection(user_prompt, img_prompt, idea_transcript, record['round_best'], round_images, image_history, prompt_history, reflection_history, args)
+        else:
+            reflection_text = ''
+        reflection_history.append(reflection_text)
+        trace_string = ''
+        trace_string += '===========\nEnd of round %d:\n'%rounds
+        trace_string += 'user_prompt: %s\n'%user_prompt
+        trace_string += 'image_history: %s\n'%image_history[-1]
+        trace_string += 'select_history: %s\n'%select_history[-1]
+        trace_string += 'prompt_history: %s\n'%prompt_history[-1]
+        trace_string += 'reflection_history: %s\n===========\n'%reflection_history[-1]
+        print(trace_string)
+        with trace.span('io.trace_record'), open(text_record, 'a') as f:
+            f.write(trace_string)
+        if rounds == 0:
+            await copy_result(image_history[-1], 'round1', sample_name, args)
+        record.update(stage='reflected')
+        save_checkpoint(state_path, state)
+        if record.get('stop'):
+            break
+    ## save indexed image
+    await copy_result(image_history[-1], 'iter', sample_name, args)
+
+    start_ind = 1 if len(image_history) > 1 else 0
+    if len(image_history)-start_ind == 1:
+        global_best, select_response = start_ind, 'Skipped: single candidate.'
+    elif state['rounds'][len(image_history)-1].get('stop') == 'threshold':
+        ## the last round reached --score_threshold; scores of different rounds come from separate
+        ## judge calls and are not comparable, so only this stop settles the final choice
+        global_best, select_response = len(image_history)-1, 'Skipped: round %d reached score %g.'%(len(image_history)-1, score_history[-1])
+    else:
+        global_best, select_response, _ = await gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, image_history[start_ind:], args)
+        global_best += start_ind
+    await copy_result(image_history[global_best], 'iter_best', sample_name, args)
+    with trace.span('io.trace_record'), open(text_record, 'a') as f:
+        f.write('Final selection: %d. || '%global_best+select_response)
+        f.write('===========\nFinal Selection: Round: %d.\n==========='%global_best)
+    state.update(done=True, final={'global_best': global_best, 'select_response': select_response})
+    await store.flush()
+    save_checkpoint(state_path, state)
+    return state
+
+class gpu_worker():
+    ## single queue in front of the T2I model: every sample submits its diffusion jobs here
+    ## and they run one at a time, in submission order, on a dedicated thread
+    def __init__(self, t2i_model):
+        self.t2i_model = t2i_model
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='t2i')
+        self.busy_time, self.jobs = 0., 0
+
+    def timed(self, submitted, fn, *args, **kwargs):
+        start = time.perf_counter()
+        images = len(args[-1]) if fn.__name__.endswith('_batch') else 1 ## prompts are the last positional argument
+        try:
+            with trace.span('t2i.'+fn.__name__, images=images, queue_wait=start-submitted):
+                return fn(*args, **kwargs)
+        finally:
+            self.busy_time += time.perf_counter()-start
+            self.jobs += 1
+
+    async def run(self, fn, *args, **kwargs):
+        ## the sample context travels with the job so GPU spans are attributed to their sample
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(context.run, self.timed, time.perf_counter(), fn, *args, **kwargs))
+
+    async def inference(self, prompt, savename):
+        return await self.run(self.t2i_model.inference, prompt, savename)
+
+    async def img2img_inference(self, image, prompt, savename, strength=1.0):
+        return await self.run(self.t2i_model.img2img_inference, image, prompt, savename, strength=strength)
+
+    async def inference_batch(self, prompts, savenames=None, return_latents=False):
+        return await self.run(self.t2i_model.inference_batch, prompts, savenames=savenames, return_latents=return_latents)
+
+    async def img2img_inference_batch(self, image, prompts, savenames=None, strength=1.0, return_latents=False):
+        return await self.run(self.t2i_model.img2img_inference_batch, image, prompts, savenames=savenames, strength=strength, return_latents=return_latents)
+
+    def stats(self):
+        return 't2i worker: %d jobs, %.1fs busy'%(self.jobs, self.busy_time)
+
+claim_poll_interval = 5
+
+class work_queue():
+    ## samples claimed dynamically by any number of workers sharing output/<foldername>: a claim is an
+    ## exclusive fcntl lock on the sample's lock file, held for as long as the worker runs the sample.
+    ## The OS (or the NFS lock manager) drops the lock when a worker dies, so there is no takeover race.
+    ## Lock files are never unlinked: removing one while another worker has it open would let a third
+    ## worker lock a new file under the same name
+    def __init__(self, claim_dir):
+        self.claim_dir = claim_dir
+        self.owner = '%s:%d'%(socket.gethostname(), os.getpid())
+        self.held = {}
+        os.makedirs(self.claim_dir, exist_ok=True)
+
+    def path(self, sample_name):
+        return os.path.join(self.claim_dir, sample_name+'.lock')
+
+    def claim(self, sample_name):
+        ## fcntl locks belong to the process, so a second lock from this worker would succeed: refuse it here
+        if sample_name in self.held:
+            return False
+        fd = os.open(self.path(sample_name), os.O_CREAT|os.O_RDWR, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, ('%s %f\n'%(self.owner, time.time())).encode('utf-8'))
+        self.held[sample_name] = fd
+        return True
+
+    def release(self, sample_name):
+        fd = self.held.pop(sample_name, None)
+        if fd is not None:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+async def run_samples(sample_list, gpu, args, queue=None):
+    ## keep several samples in flight so GPT round trips of one sample overlap with diffusion of another;
+    ## rounds within a sample still run strictly in order
+    inflight = asyncio.Semaphore(max(args.max_inflight_samples,1))
+    progress = tqdm(total=len(sample_list))
+    async def run_one(sample):
+        ## returns False when another claim holds the sample, so it is tried again on the next pass
+        async with inflight:
+            sample_name = get_sample_name(sample)
+            state = load_checkpoint(checkpoint_path(args, sample_name)) if queue is not None else None
+            if state is not None and state['done']:
+                pass
+            elif queue is None:
+                try:
+                    await run_sample(sample, gpu, args)
+                except gpt_error as e:
+                    print('sample failed: %s || %s'%(sample, e))
+            elif queue.claim(sample_name):
+                try:
+                    ## another worker may have finished it between the check above and the claim
+                    state = load_checkpoint(checkpoint_path(args, sample_name))
+                    if state is None or not state['done']:
+                        await run_sample(sample, gpu, args)
+                except gpt_error as e:
+                    print('sample failed: %s || %s'%(sample, e))
+                finally:
+                    queue.release(sample_name)
+            else:
+                return False
+            progress.update(1)
+            return True
+    start = time.perf_counter()
+    pending = sample_list
+    while True:
+        handled = await asyncio.gather(*[run_one(sample) for sample in pending])
+        pending = [sample for sample, done in zip(pending, handled) if not done]
+        if not pending:
+            break
+        ## samples claimed elsewhere: wait for those claims to end, then finish or pick up what they left
+        await asyncio.sleep(claim_poll_interval)
+    progress.close()
+    print('%d samples in %.1fs, %s'%(len(sample_list), time.perf_counter()-start, gpu.stats()))
+
+def merge_run(sample_list, args):
+    ## consolidate the state, traces and result images written by all shards/workers into one summary
+    summary = {'foldername': args.foldername, 'samples': []}
+    for sample in sample_list:
+        sample_name = get_sample_name(sample)
+        state = load_checkpoint(checkpoint_path(args, sample_name))
+        text_record = 'output/%s/tmp/%s.txt'%(args.foldername,sample_name)
+        entry = {'sample': sample, 'name': sample_name, 'status': 'missing' if state is None else 'done' if state['done'] else 'partial'}
+        if state is not None:
+            entry.update({k: state.get(k) for k in ['prompt_history','select_history','image_history','reflection_history','bestidx_history','score_history','final']})
+        for key in ['round1','iter','iter_best']:
+            result = 'output/%s/%s/%s.png'%(args.foldername,key,sample_name)
+            entry[key] = result if os.path.exists(result) else None
+        if os.path.exists(text_record):
+            with open(text_record, 'r') as f:
+                entry['trace'] = f.read()
+        summary['samples'].append(entry)
+    summary['counts'] = {status: sum(x['status'] == status for x in summary['samples']) for status in ['done','partial','missing']}
+    summary_path = 'output/%s/summary.json'%args.foldername
+    with open(summary_path+'.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(summary_path+'.tmp', summary_path)
+    for key in ['round1','iter','iter_best']:
+        shutil.copytree('output/%s/%s'%(args.foldername,key), 'output/%s/tmp/%s'%(args.foldername,key), dirs_exist_ok=True)
+    print('merged %d samples into %s: %s'%(len(sample_list), summary_path, summary['counts']))
+
+class job_service():
+    ## --serve: Idea2Img jobs submitted over local HTTP, sharing the loaded T2I model (one gpu_worker)
+    ## and the pooled gpt client. A bounded priority queue turns new jobs away with 429 once full;
+    ## --max_inflight_samples jobs run at a time, each in its own output/<foldername>/jobs/<id>
+    def __init__(self, gpu, args):
+        self.gpu, self.args = gpu, args
+        self.lock = threading.Lock()
+        self.queue, self.jobs, self.seq = [], OrderedDict(), 0
+        self.loop, self.wakeup = None, None
+
+    def submit(self, request):
+        ## returns the queued job, or None when the queue is full
+        idea = request.get('idea')
+        if not isinstance(idea, str) or not idea.strip():
+            raise ValueError('"idea" must be a non-empty string')
+        sample = ' '.join(idea.split())
+        if request.get('image'):
+            sample = '%s <IMG>%s'%(sample, request['image'])
+        for path in sample.split('<IMG>')[1::2]:
+            if not os.path.isfile(path.strip()):
+                raise ValueError('image not found: %s'%path.strip())
+        overrides = {k: int(request[k]) for k in ['max_rounds','num_prompt','num_img'] if k in request}
+        if any(v < 1 for v in overrides.values()):
+            raise ValueError('max_rounds, num_prompt and num_img must be positive')
+        priority = int(request.get('priority', 0))
+        with self.lock:
+            if len(self.queue) >= self.args.queue_size:
+                return None
+            self.seq += 1
+            job = {'id': uuid.uuid4().hex[:12], 'sample': sample, 'priority': priority, 'overrides': overrides, 'status': 'queued',
+                   'submitted': time.time(), 'started': None, 'finished': None, 'error': None, 'state': None}
+            heapq.heappush(self.queue, (-priority, self.seq, job['id'])) ## higher priority first, FIFO within a priority
+            self.jobs[job['id']] = job
+            self.evict()
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job
+
+    def evict(self):
+        ## forget the oldest finished jobs beyond --keep_jobs; their files stay in output/
+        finished = [x for x in self.jobs.values() if x['status'] in ('done','failed')]
+        for job in finished[:max(len(finished)-self.args.keep_jobs, 0)]:
+            del self.jobs[job['id']]
+
+    def status(self, job):
+        with self.lock:
+            position = None
+            if job['status'] == 'queued':
+                position = [x[2] for x in sorted(self.queue)].index(job['id'])
+        return {'id': job['id'], 'idea': job['sample'], 'status': job['status'], 'priority': job['priority'], 'queue_position': position,
+                'submitted': job['submitted'], 'started': job['started'], 'finished': job['finished'], 'error': job['error']}
+
+    def folder(self, job):
+        return '%s/jobs/%s'%(self.args.foldername, job['id'])
+
+    def result(self, job):
+        state, sample_name = job['state'], get_sample_name(job['sample'])
+        rounds = [{'prompt': prompt, 'image': image, 'selection': selection, 'reflection': reflection, 'score': score}
+                  for prompt, image, selection, reflection, score in zip(state['prompt_history'], state['image_history'], state['select_history'], state['reflection_history'], state['score_history'])]
+        return {'id': job['id'], 'idea': job['sample'], 'best_image': 'output/%s/iter_best/%s.png'%(self.folder(job), sample_name),
+                'last_image': 'output/%s/iter/%s.png'%(self.folder(job), sample_name), 'best_round': state['final']['global_best'],
+                'selection_rationale': state['final']['select_response'], 'rounds': rounds}
+
+    def stats(self):
+        with self.lock:
+            counts = {status: sum(x['status'] == status for x in self.jobs.values()) for status in ['queued','running','done','failed']}
+        return {'jobs': counts, 'queue_size': self.args.queue_size, 't2i': self.gpu.stats(), 'gpt': gpt.stats()}
+
+    async def worker(self):
+        while True:
+            with self.lock:
+                job = self.jobs[heapq.heappop(self.queue)[2]] if self.queue else None
+                if job is not None:
+                    job.update(status='running', started=time.time())
+            if job is None:
+                ## cleared in the same step as the empty check, so a submit in between still wakes us
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            args = argparse.Namespace(**dict(vars(self.args), **job['overrides'], foldername=self.folder(job), resume=False))
+            for key in ['iter','round1','iter_best','tmp','state']:
+                os.makedirs('output/%s/%s'%(args.foldername,key), exist_ok=True)
+            try:
+                state = await run_sample(job['sample'], self.gpu, args)
+                job.update(status='done', state=state)
+            except Exception as e: ## a failed job must not take the service down
+                print('job %s failed: %s || %s'%(job['id'], job['sample'], e))
+                job.update(status='failed', error='%s: %s'%(type(e).__name__, e))
+            job['finished'] = time.time()
+
+    async def serve(self, host, port):
+        self.loop, self.wakeup = asyncio.get_running_loop(), asyncio.Event()
+        server = http.server.ThreadingHTTPServer((host, port), job_handler)
+        server.daemon_threads = True
+        server.service = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print('serving idea2img jobs on http://%s:%d'%server.server_address[:2])
+        try:
+            await asyncio.gather(*[self.worker() for _ in range(max(self.args.max_inflight_samples,1))])
+        finally:
+            server.shutdown()
+            print(trace.summary())
+            trace.export()
+
+class job_handler(http.server.BaseHTTPRequestHandler):
+    ## POST /jobs {"idea", "image", "priority", "max_rounds", "num_prompt", "num_img"} -> 202 with the job id
+    ## GET /jobs/<id>, /jobs/<id>/result, /jobs/<id>/image and /stats
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload, headers={}):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            job = service.submit(request)
+        except (ValueError, TypeError, AttributeError) as e:
+            return self.reply(400, {'error': str(e)})
+        if job is None:
+            return self.reply(429, {'error': 'job queue full'}, {'Retry-After': '30'})
+        self.reply(202, service.status(job), {'Location': '/jobs/%s'%job['id']})
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.path.strip('/').split('/')
+        if parts == ['stats']:
+            return self.reply(200, service.stats())
+        job = service.jobs.get(parts[1]) if len(parts) in (2,3) and parts[0] == 'jobs' else None
+        if job is None:
+            return self.reply(404, {'error': 'not found'})
+        if len(parts) == 2:
+            return self.reply(200, service.status(job))
+        if job['status'] != 'done':
+            return self.reply(500 if job['status'] == 'failed' else 409, service.status(job))
+        if parts[2] == 'result':
+            return self.reply(200, service.result(job))
+        if parts[2] == 'image':
+            with open(service.result(job)['best_image'], 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+        self.reply(404, {'error': 'not found'})
 
 def main():
+    startup.mark('imports')
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--api_key", type=str, help="OpenAI GPT-4V API key; https://platform.openai.com/docs/guides/vision")
+    parser.add_argument("--api_key", type=str, help="Azure OpenAI API key; managed identity is used when omitted")
     # parser.add_argument("--huggingface_key", type=str, help="huggingface SD3 key")
     parser.add_argument("--testfile", type=str, default="testsample.txt")
     parser.add_argument("--num_img", type=int, default=1, help="number of images to generate per prompt")
@@ -401,8 +1877,58 @@ def main():
     parser.add_argument("--fewshot", default=False, action="store_true")
     parser.add_argument("--select_fewshot", default=False, action="store_true")
     parser.add_argument("--img2img", default=False, action="store_true", help="if use SD3 img2img pipeline, instead of SD3 T2I. Both with refiner in default.")
+    parser.add_argument("--img_detail", type=str, default="low", choices=["low","high","auto"], help="detail level requested for images sent to GPT")
+    parser.add_argument("--img_max_side", type=int, default=None, help="images sent to GPT are downscaled to this longest side, 0 to keep full resolution; by default the size GPT keeps at --img_detail (512px for low, 768px short side for high/auto)")
+    parser.add_argument("--img_format", type=str, default="jpeg", choices=["jpeg","webp","png","raw"], help="encoding of images sent to GPT; raw sends the original file bytes")
+    parser.add_argument("--img_quality", type=int, default=85, help="jpeg/webp quality of images sent to GPT")
+    parser.add_argument("--history_images", type=int, default=-1, help="previous rounds that keep their image in reflection/revision prompts; older rounds become a text digest. -1 keeps all")
+    parser.add_argument("--history_budget", type=int, default=0, help="estimated token budget of the round history in reflection/revision prompts, 0 for unlimited")
+    parser.add_argument("--img_cache_mb", type=int, default=256, help="memory budget of the encoded image cache")
+    parser.add_argument("--img_cache_dir", type=str, default=None, help="optional on-disk tier of the encoded image cache, reused across runs")
+    parser.add_argument("--gpt_concurrency", type=int, default=4, help="max GPT requests in flight")
+    parser.add_argument("--gpt_rpm", type=int, default=0, help="GPT requests-per-minute quota of the deployment, 0 for unlimited")
+    parser.add_argument("--gpt_tpm", type=int, default=0, help="GPT tokens-per-minute quota of the deployment, 0 for unlimited")
+    parser.add_argument("--gpt_cache", type=str, default="off", choices=["off","on","record","replay"], help="GPT response cache: on = serve and store, record = always query and store, replay = serve recorded responses only, offline")
+    parser.add_argument("--gpt_cache_dir", type=str, default="gpt_cache", help="directory of the GPT response cache")
+    parser.add_argument("--gpt_cache_mb", type=int, default=512, help="size bound of the GPT response cache")
+    parser.add_argument("--max_inflight_samples", type=int, default=3, help="samples processed concurrently; their GPT calls overlap with diffusion on the shared GPU worker")
+    parser.add_argument("--gpt_max_retries", type=int, default=8, help="retry budget of each GPT request")
+    parser.add_argument("--gpt_stream", default=False, action="store_true", help="stream prompt generation and start T2I on each prompt as soon as it is complete")
+    parser.add_argument("--t2i_model", type=str, default="sdxl", choices=sorted(t2i_registry), help="T2I backend; remote uses the model of a server started with --t2i_serve")
+    parser.add_argument("--t2i_serve", default=False, action="store_true", help="load --t2i_model once and serve it on --t2i_socket to any number of pipeline runs, instead of running the test file")
+    parser.add_argument("--serve", default=False, action="store_true", help="keep the models loaded and serve jobs over local HTTP instead of running the test file")
+    parser.add_argument("--serve_host", type=str, default="127.0.0.1")
+    parser.add_argument("--serve_port", type=int, default=8700)
+    parser.add_argument("--queue_size", type=int, default=64, help="in --serve mode, queued jobs beyond this are rejected with 429")
+    parser.add_argument("--keep_jobs", type=int, default=1000, help="in --serve mode, finished jobs whose status and result stay available")
+    parser.add_argument("--t2i_socket", type=str, default="output/t2i.sock", help="unix socket of the T2I model server")
+    parser.add_argument("--no_refiner", default=False, action="store_true", help="skip loading and running the refiner")
+    parser.add_argument("--dry_run", default=False, action="store_true", help="parse the test file and print the planned work, without loading models or calling GPT")
+    parser.add_argument("--trace_dir", type=str, default=None, help="write per-span metrics (JSONL) and a Chrome/Perfetto trace of the run here")
+    parser.add_argument("--adaptive", default=False, action="store_true", help="stop refining a sample once its selected image reaches --score_threshold or scores plateau; the final re-ranking is skipped when the last round reached the threshold")
+    parser.add_argument("--score_threshold", type=float, default=9., help="select score that ends refinement in --adaptive mode")
+    parser.add_argument("--plateau_rounds", type=int, default=2, help="in --adaptive mode, stop when the best score has not improved for this many rounds, 0 to disable")
+    parser.add_argument("--min_rounds", type=int, default=1, help="rounds always run before --adaptive may stop")
+    parser.add_argument("--resume", default=False, action="store_true", help="skip samples finished by an earlier run and continue partial ones from their last checkpointed stage")
+    parser.add_argument("--shard_index", "--shard-index", type=int, default=0, help="index of this worker's static shard of the test file")
+    parser.add_argument("--num_shards", "--num-shards", type=int, default=1, help="number of static shards the test file is split into")
+    parser.add_argument("--work_queue", default=False, action="store_true", help="claim samples dynamically through lock files under output/<foldername>/claims, so any number of workers can share one test file")
+    parser.add_argument("--merge", default=False, action="store_true", help="consolidate results of all shards/workers into output/<foldername>/summary.json and exit")
+    parser.add_argument("--stub_delay", type=float, default=0.5, help="seconds per image of the stub backend")
+    parser.add_argument("--reuse_latent", default=False, action="store_true", help="with --img2img, seed each round of a sample with an input image from the previous round's best base latent instead of re-encoding an image; text-only samples are unaffected")
+    parser.add_argument("--dedup", default=False, action="store_true", help="skip diffusion for placeholder and near-duplicate prompts, reuse earlier rounds' images for repeated prompts, and drop near-identical images before selection")
+    parser.add_argument("--dedup_threshold", type=float, default=1.0, help="word overlap (Jaccard) from which two prompts of a round count as duplicates; 1.0 = same words. Earlier rounds' images are only reused for exactly the same prompt")
+    parser.add_argument("--dedup_hamming", type=int, default=4, help="max dHash distance (of 64 bits) between two images that count as duplicates")
+    parser.add_argument("--t2i_batch_size", type=int, default=0, help="max images per diffusion call, 0 to size batches by free GPU memory")
     args = parser.parse_args()
-    assert(args.num_img==1)
+    startup.mark('parse args')
+    if args.trace_dir is not None:
+        trace.open(args.trace_dir)
+
+    global img_cache, gpt
+    img_cache = image_cache(max_bytes=args.img_cache_mb*1024*1024, disk_dir=args.img_cache_dir, prep=image_prep(detail=args.img_detail, max_side=args.img_max_side, fmt=args.img_format, quality=args.img_quality))
+    cache = response_cache(args.gpt_cache_dir, max_bytes=args.gpt_cache_mb*1024*1024) if args.gpt_cache != 'off' else None
+    gpt = gpt_client(api_key=args.api_key, max_concurrency=args.gpt_concurrency, rpm=args.gpt_rpm, tpm=args.gpt_tpm, max_retries=args.gpt_max_retries, cache=cache, cache_mode=args.gpt_cache)
 
     # from huggingface_hub import login
     # access_token_write = args.huggingface_key
@@ -411,89 +1937,52 @@ def main():
     # global api_key
     # api_key = args.api_key
 
+    if args.t2i_serve:
+        os.makedirs(os.path.dirname(os.path.abspath(args.t2i_socket)), exist_ok=True)
+        t2i_server(t2i_registry[args.t2i_model].from_args(args), args.t2i_socket).serve_forever()
+        return
+
+    sample_list = [] if args.serve else [x.strip() for x in list(open(args.testfile,'r'))]
+    if args.merge:
+        merge_run(sample_list, args)
+        return
+    if args.num_shards > 1:
+        sample_list = sample_list[args.shard_index::args.num_shards]
+    if args.work_queue:
+        args.resume = True ## a sample may be picked up after another worker died halfway
+    if args.dry_run:
+        print('%d samples, %d rounds x %d prompts x %d images, backend %s%s%s'%(len(sample_list), args.max_rounds, args.num_prompt, args.num_img, args.t2i_model, '' if args.no_refiner or not t2i_registry[args.t2i_model].has_refiner else ' + refiner', ' + img2img' if args.img2img else ''))
+        print('up to %d GPT calls and %d diffusion images'%(len(sample_list)*(3*args.max_rounds), len(sample_list)*args.max_rounds*args.num_prompt*args.num_img))
+        print(startup.report())
+        return
     os.system('mkdir -p output/%s'%args.foldername)
     os.system('mkdir -p output/%s/iter'%args.foldername)
     os.system('mkdir -p output/%s/round1'%args.foldername)
     os.system('mkdir -p output/%s/iter_best'%args.foldername)
-    os.system('mkdir output/%s/tmp'%args.foldername)
+    os.system('mkdir -p output/%s/tmp'%args.foldername)
+    os.system('mkdir -p output/%s/state'%args.foldername)
 
-    sample_list = [x.strip() for x in list(open(args.testfile,'r'))]
     # t2i_model = t2i_sd15()
-    t2i_model = t2i_sdxl(refiner=True, img2img=True)
-
-    for sample_ii in tqdm(range(len(sample_list))):
-        user_prompt, img_prompt = sample_list[sample_ii], None
-        prompt_list = user_prompt.split('<IMG>')
-        user_prompt = user_prompt.split('<IMG>')[0] ## legacy, for naming use only
-        idea_transcript = []
-        for ii in range(len(prompt_list)):
-            if ii == 0:
-                idea_transcript.append("IDEA: %s."%prompt_list[0])
-            elif ii%2==1:
-                idea_transcript.append(load_img(prompt_list[ii]))
-            elif ii%2==0:
-                idea_transcript.append("%s"%prompt_list[ii])
-        idea_transcript.append("End of IDEA.\n")
-
-        text_record = 'output/%s/tmp/%s.txt'%(args.foldername,user_prompt.replace(' ','').replace('.',''))
-        os.system('mkdir output/%s/tmp/%s'%(args.foldername,user_prompt.replace(' ','').replace('.','')))
-
-        ### GPTV prompting iter
-        current_prompts, prompt_history, select_history, image_history, reflection_history, bestidx_history = [],[],[],[],[],[]
-        for rounds in range(args.max_rounds):
-            if args.verbose: print('ROUND %d:\n'%rounds)
-            ###### new rounds' prompt (init/revision)
-            if rounds == 0:
-                gptv_prompts = gptv_init_prompt(user_prompt, None, idea_transcript, args)
-            else:
-                gptv_prompts = gptv_revision_prompt(user_prompt, None, idea_transcript, image_history, prompt_history, reflection_history, args)
-            current_prompts = gptv_prompts
-            ###### t2i generation
-            for ii in range(args.num_prompt):
-                for jj in range(args.num_img):
-                    if args.img2img:
-                        if '<IMG>' in sample_list[sample_ii]:
-                            t2i_model.img2img_inference(Image.open(sample_list[sample_ii].split('<IMG>')[1]).resize((1024,1024)), gptv_prompts[ii],'output/%s/tmp/%s/%d_%d_%d.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,ii,jj),strength=args.strength)
-                        else:
-                            t2i_model.inference(gptv_prompts[ii],'output/%s/tmp/%s/%d_%d_%d.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,ii,jj))
-                    else: ## T2I
-                        t2i_model.inference(gptv_prompts[ii],'output/%s/tmp/%s/%d_%d_%d.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,ii,jj))
-            ###### reflection: first select best, then give reason to improve (i.e., reflection)
-            round_best, select_response = gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, ['output/%s/tmp/%s/%d_%d_0.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,ii) for ii in range(args.num_prompt)], args)
-            ## select the best, give an index. two separate calls
-            prompt_history.append(current_prompts[round_best])
-            select_history.append('Round selection: %d. || '%round_best+select_response)
-            image_history.append('output/%s/tmp/%s/%d_%d_0.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,round_best))
-            bestidx_history.append(round_best)
-            if rounds!=args.max_rounds-1:
-                reflection_text = gptv_reflection_prompt_textreflection(user_prompt, img_prompt, idea_transcript, round_best, ['output/%s/tmp/%s/%d_%d_0.png'%(args.foldername,user_prompt.replace(' ','').replace('.',''),rounds,ii) for ii in range(args.num_prompt)], image_history, prompt_history, reflection_history, args)
-            else:
-                reflection_text = ''
-            reflection_history.append(reflection_text)
-            trace_string = ''
-            trace_string += '===========\nEnd of round %d:\n'%rounds
-            trace_string += 'user_prompt: %s\n'%user_prompt
-            trace_string += 'image_history: %s\n'%image_history[-1]
-            trace_string += 'select_history: %s\n'%select_history[-1]
-            trace_string += 'prompt_history: %s\n'%prompt_history[-1]
-            trace_string += 'reflection_history: %s\n===========\n'%reflection_history[-1]
-            print(trace_string)
-            with open(text_record, 'a') as f:
-                f.write(trace_string)
-            if rounds == 0:
-                os.system('cp %s output/%s/round1/%s.png'%(image_history[-1],args.foldername,user_prompt.replace(' ','').replace('.','')))
-        ## save indexed image
-        os.system('cp %s output/%s/iter/%s.png'%(image_history[-1],args.foldername,user_prompt.replace(' ','').replace('.','')))
+    t2i_model = t2i_registry[args.t2i_model].from_args(args)
+    print(startup.report())
+    if args.reuse_latent and not t2i_model.capabilities()['has_latents']:
+        print('--reuse_latent: backend %s returns no base latents, rounds are seeded from images'%t2i_model.name)
 
-        start_ind = 1
-        global_best, select_response = gptv_reflection_prompt_selectbest(user_prompt, img_prompt, idea_transcript, image_history[start_ind:], args)
-        global_best += start_ind
-        os.system('cp %s output/%s/iter_best/%s.png'%(image_history[global_best],args.foldername,user_prompt.replace(' ','').replace('.','')))
-        with open(text_record, 'a') as f:
-            f.write('Final selection: %d. || '%global_best+select_response)
-            f.write('===========\nFinal Selection: Round: %d.\n==========='%global_best)
-    for key in ['round1','iter','iter_best']:
-        os.system('cp -r output/%s/%s output/%s/tmp/%s'%(args.foldername,key,args.foldername,key))
+    if args.serve:
+        asyncio.run(job_service(gpu_worker(t2i_model), args).serve(args.serve_host, args.serve_port))
+        return
+    queue = work_queue('output/%s/claims'%args.foldername) if args.work_queue else None
+    asyncio.run(run_samples(sample_list, gpu_worker(t2i_model), args, queue=queue))
+    if args.num_shards == 1 and not args.work_queue:
+        for key in ['round1','iter','iter_best']:
+            os.system('cp -r output/%s/%s output/%s/tmp/%s'%(args.foldername,key,args.foldername,key))
+    print(img_cache.stats())
+    print(img_cache.prep.stats())
+    print(gpt.stats())
+    if gpt.cache is not None:
+        print(gpt.cache.stats())
+    print(trace.summary())
+    trace.export()
 
 if __name__ == '__main__':
     main()